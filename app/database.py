@@ -2,13 +2,19 @@
 CICLOPS - Configuracion de PostgreSQL
 """
 import os
-from sqlalchemy import create_engine
+import logging
+import orjson
+from sqlalchemy import create_engine, inspect, text, Float, Numeric
+from sqlalchemy.pool import StaticPool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from typing import Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Railway provee DATABASE_URL automaticamente cuando agregas Postgres
 DATABASE_URL = os.getenv("DATABASE_URL")
 
@@ -22,17 +28,236 @@ else:
         DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
     print("✅ Conectado a PostgreSQL")
 
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-    echo=False  # Cambiar a True para debug SQL
-)
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+
+def json_serializer(obj) -> str:
+    """
+    Serializador de las columnas JSON (preview_data, raw_json, columns) con orjson.
+    Fechas/Decimal de pandas se guardan como texto y NaN como null (JSON valido).
+    """
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    return orjson.dumps(obj, default=str, option=option).decode()
+
+
+if IS_SQLITE:
+    # SQLite no soporta pool real; una sola conexion compartida entre threads
+    engine = create_engine(
+        DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+        json_serializer=json_serializer,
+        json_deserializer=orjson.loads,
+        echo=False
+    )
+else:
+    # Pool dimensionado para rafagas de FastAPI. Sin pre_ping (evita un
+    # SELECT 1 por checkout); pool_recycle renueva conexiones antes de que
+    # el proxy de Railway las cierre por inactividad.
+    engine = create_engine(
+        DATABASE_URL,
+        pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "40")),
+        pool_recycle=1800,
+        pool_pre_ping=False,
+        pool_use_lifo=True,  # Reusar la conexion mas reciente (caliente)
+        connect_args={"options": "-c statement_timeout=5000"},
+        json_serializer=json_serializer,
+        json_deserializer=orjson.loads,
+        echo=False  # Cambiar a True para debug SQL
+    )
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
 
+def disable_statement_timeout(conn, local: bool = True):
+    """
+    Quita el statement_timeout de 5 s del pool en una conexion de migracion:
+    un CREATE INDEX CONCURRENTLY o un ALTER TABLE sobre una tabla grande
+    tarda mas y, cancelado, deja indices INVALID. Con local=True (SET LOCAL)
+    aplica solo a la transaccion; en AUTOCOMMIT hay que hacer RESET al terminar.
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    scope = "LOCAL " if local else ""
+    conn.execute(text(f"SET {scope}statement_timeout = 0"))
+
+
+def add_missing_columns():
+    """
+    Agrega a las tablas existentes las columnas nuevas de los modelos.
+    Solo columnas nullable sin default: ALTER TABLE ... ADD COLUMN es
+    instantaneo y no reescribe la tabla. Tambien convierte a numeric las
+    columnas de montos/porcentajes que se crearon como double precision.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        disable_statement_timeout(conn)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col["name"]: col for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    if _needs_numeric_conversion(column, existing[column.name]["type"]):
+                        _convert_to_numeric(conn, table.name, column)
+                    continue
+                if not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                print(f"✅ Columna agregada: {table.name}.{column.name}")
+
+
+def _needs_numeric_conversion(column, current_type) -> bool:
+    """
+    Columna Numeric del modelo que en PostgreSQL sigue como real/double
+    precision, o que quedo como numeric(p, s) y el modelo ya no limita
+    (Percent): quitar la precision no reescribe la tabla.
+    """
+    if engine.dialect.name != "postgresql":
+        return False  # SQLite no distingue: la afinidad NUMERIC/REAL guarda igual
+    if not isinstance(column.type, Numeric) or isinstance(column.type, Float):
+        return False
+    if isinstance(current_type, Float):
+        return True
+    return (
+        isinstance(current_type, Numeric)
+        and column.type.precision is None
+        and current_type.precision is not None
+    )
+
+
+def _convert_to_numeric(conn, table_name: str, column):
+    """
+    ALTER COLUMN ... TYPE numeric(p, s). Reescribe la tabla (una sola vez).
+    En un SAVEPOINT: si un valor no cabe en la precision, la columna se
+    queda como estaba y el resto de la migracion sigue.
+    """
+    column_type = column.type.compile(dialect=engine.dialect)
+    try:
+        with conn.begin_nested():
+            conn.execute(text(
+                f"ALTER TABLE {table_name} ALTER COLUMN {column.name} "
+                f"TYPE {column_type} USING {column.name}::{column_type}"
+            ))
+        print(f"✅ Columna convertida: {table_name}.{column.name} -> {column_type}")
+    except Exception as e:
+        logger.error("No se pudo convertir %s.%s a %s: %s", table_name, column.name, column_type, e)
+
+
+def update_foreign_key_cascades():
+    """
+    Aplica ON DELETE declarado en los modelos a las FKs de tablas existentes
+    (create_all() no modifica constraints ya creados). Solo PostgreSQL:
+    SQLite no permite alterar constraints.
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        disable_statement_timeout(conn)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = inspector.get_foreign_keys(table.name)
+            for fk in table.foreign_key_constraints:
+                if not fk.ondelete:
+                    continue
+                columns = [col.name for col in fk.columns]
+                for current in existing:
+                    if current["constrained_columns"] != columns:
+                        continue
+                    if (current.get("options") or {}).get("ondelete", "").upper() == fk.ondelete.upper():
+                        continue
+                    ref_table = fk.referred_table.name
+                    ref_columns = ", ".join(el.column.name for el in fk.elements)
+                    conn.execute(text(f'ALTER TABLE {table.name} DROP CONSTRAINT "{current["name"]}"'))
+                    conn.execute(text(
+                        f'ALTER TABLE {table.name} ADD CONSTRAINT "{current["name"]}" '
+                        f"FOREIGN KEY ({', '.join(columns)}) REFERENCES {ref_table} ({ref_columns}) "
+                        f"ON DELETE {fk.ondelete}"
+                    ))
+                    print(f"✅ FK actualizada: {table.name}.{current['name']} ON DELETE {fk.ondelete}")
+
+
+def create_missing_indexes():
+    """
+    Crea los indices declarados en los modelos que aun no existen.
+    create_all() solo crea tablas nuevas; en tablas existentes los indices
+    agregados despues hay que crearlos aparte.
+    """
+    is_postgres = engine.dialect.name == "postgresql"
+    # CREATE INDEX CONCURRENTLY no puede correr dentro de una transaccion
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if is_postgres:
+            # Sin SET LOCAL en AUTOCOMMIT: se restaura con RESET antes de
+            # devolver la conexion al pool
+            disable_statement_timeout(conn, local=False)
+            # Indices de trigramas (gin_trgm_ops) en tablas ya existentes
+            try:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            except Exception as e:
+                print(f"⚠️ No se pudo habilitar pg_trgm: {e}")
+        try:
+            _create_model_indexes(conn, is_postgres)
+        finally:
+            if is_postgres:
+                conn.execute(text("RESET statement_timeout"))
+
+
+def index_is_valid(conn, index_name: str) -> Optional[bool]:
+    """pg_index.indisvalid del indice; None si no existe"""
+    return conn.execute(text(
+        "SELECT i.indisvalid FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name AND pg_catalog.pg_table_is_visible(c.oid)"
+    ), {"name": index_name}).scalar()
+
+
+def index_ready(table_name: str, index_name: str) -> bool:
+    """El indice existe (y en PostgreSQL es valido)"""
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            return bool(index_is_valid(conn, index_name))
+    return any(ix["name"] == index_name for ix in inspect(engine).get_indexes(table_name))
+
+
+def _create_model_indexes(conn, is_postgres: bool):
+    """Crea (CONCURRENTLY en PostgreSQL) los indices de los modelos que falten"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                if is_postgres:
+                    # Un CONCURRENTLY que fallo (timeout, llave duplicada, deploy
+                    # interrumpido) deja el indice INVALID; IF NOT EXISTS lo
+                    # saltaria para siempre, asi que se borra y se reconstruye
+                    if index_is_valid(conn, index.name) is False:
+                        logger.warning("Indice %s invalido, se reconstruye", index.name)
+                        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}"))
+                    # CONCURRENTLY evita bloquear escrituras mientras se construye
+                    options = index.dialect_options["postgresql"]
+                    ops = options["ops"] or {}
+                    columns = ", ".join(
+                        f"{col.name} {ops[col.name]}" if col.name in ops else col.name
+                        for col in index.columns
+                    )
+                    unique = "UNIQUE " if index.unique else ""
+                    using = f" USING {options['using']}" if options["using"] else ""
+                    where = options["where"]
+                    where = f" WHERE {where}" if where is not None else ""
+                    conn.execute(text(
+                        f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS "
+                        f"{index.name} ON {table.name}{using} ({columns}){where}"
+                    ))
+                else:
+                    index.create(bind=conn, checkfirst=True)
+            except Exception as e:
+                logger.error("No se pudo crear indice %s: %s", index.name, e)
+
+
 def get_db():
     """Dependency para obtener sesion de DB"""
     db = SessionLocal()
@@ -2,15 +2,40 @@
 CICLOPS - Modelos SQLAlchemy para PostgreSQL
 Vault de datos financieros para Little Caesars
 """
-from sqlalchemy import Column, Integer, String, Float, DateTime, Text, JSON, ForeignKey, Boolean
+from sqlalchemy import event, DDL, text, Column, Integer, String, Numeric, DateTime, Text, JSON, ForeignKey, Boolean, Index, LargeBinary
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
 
+# Montos en pesos: decimal exacto, sin artefactos de redondeo de float
+Money = Numeric(18, 4)
+# Porcentajes (márgenes, variaciones): numeric sin precisión fija. Con ventas
+# casi en cero el margen real puede pasar de 10^6 % y un numeric(p, s) haría
+# fallar todo el UPSERT por "numeric field overflow"
+Percent = Numeric()
+
 
 class Document(Base):
     """Documento subido (PDF, Excel, CSV)"""
     __tablename__ = "documents"
+    __table_args__ = (
+        # Listados filtrados por status y ordenados por fecha (/documents, vault, chat)
+        Index("ix_doc_status_created", "status", "created_at"),
+        # /documents?status=&store_id= con paginación por cursor (btree se recorre en DESC)
+        Index("ix_doc_status_store_created", "status", "store_id", "created_at"),
+        # Parcial: solo confirmados, que son los que consultan dashboard/chat por sucursal
+        Index(
+            "ix_doc_confirmed_store_created", "store_id", "created_at",
+            postgresql_where=text("status = 'confirmed'"),
+            sqlite_where=text("status = 'confirmed'"),
+        ),
+        # Trigramas: filename ILIKE '%ESTADO DE RESULTADOS%' (/charts/financial) sin seq scan
+        Index(
+            "ix_doc_filename_trgm", "filename",
+            postgresql_using="gin",
+            postgresql_ops={"filename": "gin_trgm_ops"},
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String(255), nullable=False)
@@ -22,12 +47,21 @@ class Document(Base):
     columns = Column(JSON)  # Lista de columnas
     status = Column(String(50), default="uploaded")  # uploaded, processed, error
     uploaded_by = Column(String(255))  # UID de Firebase
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
     # Relaciones
-    financial_records = relationship("FinancialRecord", back_populates="document")
-    raw_data = relationship("RawDocumentData", back_populates="document", uselist=False)
+    # passive_deletes: la base borra los hijos (ON DELETE CASCADE), el ORM no los carga
+    financial_records = relationship("FinancialRecord", back_populates="document", passive_deletes=True)
+    raw_data = relationship("RawDocumentData", back_populates="document", uselist=False, passive_deletes=True)
+
+
+# gin_trgm_ops necesita pg_trgm antes de crear la tabla en una base nueva
+event.listen(
+    Document.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql")
+)
 
 
 class RawDocumentData(Base):
@@ -35,9 +69,10 @@ class RawDocumentData(Base):
     __tablename__ = "raw_document_data"
 
     id = Column(Integer, primary_key=True, index=True)
-    document_id = Column(Integer, ForeignKey("documents.id"), unique=True)
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), unique=True)
     raw_text = Column(Text)  # Para PDFs
-    raw_json = Column(JSON)  # Para Excel/CSV
+    raw_json = Column(JSON)  # Para Excel/CSV (metadata; "data" solo en documentos viejos)
+    raw_parquet = Column(LargeBinary)  # Datos completos de Excel/CSV en Parquet (zstd)
     preview_data = Column(JSON)  # Primeras filas para preview
 
     document = relationship("Document", back_populates="raw_data")
@@ -46,12 +81,17 @@ class RawDocumentData(Base):
 class FinancialRecord(Base):
     """Registro financiero estructurado (del P&L)"""
     __tablename__ = "financial_records"
+    __table_args__ = (
+        # Filtros combinados del dashboard; cubren también store_id y period solos
+        Index("ix_fr_store_period_cat", "store_id", "period", "category"),
+        Index("ix_fr_period_category", "period", "category"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    document_id = Column(Integer, ForeignKey("documents.id"), index=True)
-    store_id = Column(String(100), index=True)
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), index=True)
+    store_id = Column(String(100))
     store_name = Column(String(255))
-    period = Column(String(50), index=True)
+    period = Column(String(50))
 
     # Categoría del registro
     category = Column(String(100), index=True)  # ventas, costos, gastos, utilidad
@@ -59,8 +99,8 @@ class FinancialRecord(Base):
     concept = Column(String(255))  # Descripción del concepto
 
     # Valores
-    amount = Column(Float, default=0)
-    percentage = Column(Float)  # % de ventas si aplica
+    amount = Column(Money, default=0)
+    percentage = Column(Percent)  # % de ventas si aplica
 
     # Metadata
     row_number = Column(Integer)
@@ -95,39 +135,52 @@ class Analysis(Base):
     result = Column(Text)  # Respuesta de Julia
     tokens_used = Column(Integer)
     user_uid = Column(String(255))
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+
+class AIMappingCache(Base):
+    """Mapeo de campos de la IA por esquema de columnas (sobrevive reinicios)"""
+    __tablename__ = "ai_mapping_cache"
+
+    schema_hash = Column(String(40), primary_key=True)  # sha1 del esquema (_ai_cache_key)
+    result = Column(Text, nullable=False)  # JSON tal como lo devolvió la IA
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 
 class MonthlySummary(Base):
     """Resumen mensual por sucursal (para queries rápidas)"""
     __tablename__ = "monthly_summaries"
+    __table_args__ = (
+        # Una fila por tienda/periodo: permite UPSERT (ON CONFLICT)
+        Index("uq_ms_store_period", "store_id", "period", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    store_id = Column(String(100), index=True)
+    store_id = Column(String(100))  # Cubierto por uq_ms_store_period
     store_name = Column(String(255))
     period = Column(String(50), index=True)  # "2024-01"
 
     # Métricas principales
-    total_sales = Column(Float, default=0)
-    cost_of_sales = Column(Float, default=0)
-    gross_profit = Column(Float, default=0)
-    gross_margin = Column(Float)  # %
+    total_sales = Column(Money, default=0)
+    cost_of_sales = Column(Money, default=0)
+    gross_profit = Column(Money, default=0)
+    gross_margin = Column(Percent)  # %
 
-    operating_expenses = Column(Float, default=0)
-    labor_cost = Column(Float, default=0)
-    rent = Column(Float, default=0)
-    utilities = Column(Float, default=0)
+    operating_expenses = Column(Money, default=0)
+    labor_cost = Column(Money, default=0)
+    rent = Column(Money, default=0)
+    utilities = Column(Money, default=0)
 
-    net_profit = Column(Float, default=0)
-    net_margin = Column(Float)  # %
+    net_profit = Column(Money, default=0)
+    net_margin = Column(Percent)  # %
 
     # Para comparativas
-    sales_vs_previous = Column(Float)  # % cambio vs mes anterior
-    profit_vs_previous = Column(Float)
+    sales_vs_previous = Column(Percent)  # % cambio vs mes anterior
+    profit_vs_previous = Column(Percent)
 
     document_id = Column(Integer, ForeignKey("documents.id"))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
 
 class User(Base):
@@ -141,4 +194,4 @@ class User(Base):
     role = Column(String(50), default="user")  # admin, user
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -4,21 +4,41 @@ Aurelia: "El punto de entrada del backend, aquí todo se conecta"
 """
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
+import asyncio
 import logging
+import logging.handlers
+import queue
+import random
 import time
 
 from app.config import get_settings
 from app.routers import auth_router, documents_router, reports_router
-from app.services import init_firebase
+from app.services import init_firebase, get_firestore_client, get_storage_bucket
 
 # Configurar logging
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
+
+# Logging no bloqueante: los requests solo encolan el record y un thread
+# aparte lo escribe con los handlers originales
+root_logger = logging.getLogger()
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(
+    log_queue, *root_logger.handlers, respect_handler_level=True
+)
+root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+log_listener.start()
+
 logger = logging.getLogger(__name__)
 
+# Requests con error (4xx/5xx) o más lentos que esto siempre se loguean;
+# el resto se muestrea
+SLOW_REQUEST_SECONDS = 0.1
+REQUEST_LOG_SAMPLE_RATE = 0.05
+
 settings = get_settings()
 
 # Crear aplicación
@@ -37,7 +57,9 @@ app = FastAPI(
     - Aurelia (Backend Architect)
     """,
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    # orjson serializa en C; los modelos Pydantic siguen validando la salida
+    default_response_class=ORJSONResponse
 )
 
 # CORS
@@ -53,16 +75,21 @@ app.add_middleware(
 # Middleware para logging de requests
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    start_time = time.time()
+    start_time = time.perf_counter()
 
     response = await call_next(request)
 
-    process_time = time.time() - start_time
-    logger.info(
-        f"{request.method} {request.url.path} - "
-        f"Status: {response.status_code} - "
-        f"Time: {process_time:.3f}s"
-    )
+    process_time = time.perf_counter() - start_time
+    # Errores y requests lentos siempre; solo los exitosos rápidos se muestrean
+    if (
+        response.status_code >= 400
+        or process_time > SLOW_REQUEST_SECONDS
+        or random.random() < REQUEST_LOG_SAMPLE_RATE
+    ):
+        logger.info(
+            "%s %s - Status: %s - Time: %.3fs",
+            request.method, request.url.path, response.status_code, process_time
+        )
 
     return response
 
@@ -71,7 +98,7 @@ async def log_requests(request: Request, call_next):
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.error(f"Unhandled exception: {exc}", exc_info=True)
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={
             "detail": "Error interno del servidor",
@@ -80,6 +107,24 @@ async def global_exception_handler(request: Request, exc: Exception):
     )
 
 
+async def warm_up_firebase():
+    """
+    Aurelia: "Calentamos Firestore y Storage antes del primer request"
+    Una lectura trivial abre los canales TLS/gRPC para que el primer
+    request real no pague el handshake.
+    """
+    def _warm_up():
+        next(iter(get_firestore_client().collection("stores").limit(1).stream()), None)
+        get_storage_bucket().exists()
+
+    try:
+        await asyncio.to_thread(_warm_up)
+        logger.info("✅ Firebase connections warmed up")
+    except Exception as e:
+        # El warm-up es una optimización; no debe impedir el arranque
+        logger.warning(f"⚠️ Firebase warm-up failed: {e}")
+
+
 # Evento de startup
 @app.on_event("startup")
 async def startup_event():
@@ -97,6 +142,8 @@ async def startup_event():
         # En desarrollo, continuar sin Firebase
         if not settings.debug:
             raise
+    else:
+        await warm_up_firebase()
 
     logger.info(f"✅ API ready at {settings.frontend_url}")
 
@@ -105,6 +152,8 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info("👋 Shutting down Little Caesars Reports API...")
+    # Vaciar la cola de logs antes de salir
+    log_listener.stop()
 
 
 # Registrar routers
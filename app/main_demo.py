@@ -7,12 +7,13 @@ Incluye: Chat con Julia, Vault de datos
 
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from openai import OpenAI
-from anthropic import Anthropic
+from fastapi.responses import ORJSONResponse
+from openai import AsyncOpenAI
+from anthropic import AsyncAnthropic
 from pydantic import BaseModel
 import pandas as pd
-import json
+import orjson
+import httpx
 import os
 from io import BytesIO
 from dotenv import load_dotenv
@@ -26,7 +27,9 @@ load_dotenv()
 app = FastAPI(
     title="CICLOPS API - Demo Mode",
     description="API para análisis financiero de Little Caesars con Julia AI",
-    version="2.0.0"
+    version="2.0.0",
+    # orjson serializa todas las respuestas en Rust en lugar de json stdlib
+    default_response_class=ORJSONResponse
 )
 
 
@@ -60,18 +63,30 @@ ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 # AI Provider preference (openai or anthropic)
 ai_provider = os.getenv("AI_PROVIDER", "openai")
 
+# Un solo pool HTTP para ambos SDKs (y para los clientes que crea /settings):
+# las conexiones keep-alive evitan repetir TCP+TLS en cada llamada
+ai_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=120),
+    timeout=httpx.Timeout(120.0, connect=10.0)
+)
+
 if OPENAI_API_KEY:
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=ai_http_client)
     print("✅ OpenAI API configurada correctamente")
 else:
     print("⚠️ OPENAI_API_KEY no encontrada")
 
 if ANTHROPIC_API_KEY:
-    anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY)
+    anthropic_client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY, http_client=ai_http_client)
     print("✅ Anthropic API configurada correctamente")
 else:
     print("⚠️ ANTHROPIC_API_KEY no encontrada")
 
+
+@app.on_event("shutdown")
+async def close_ai_http_client():
+    await ai_http_client.aclose()
+
 # Almacenamiento en memoria (demo)
 documents_store = []
 analysis_store = []
@@ -137,13 +152,13 @@ async def update_settings(settings: SettingsUpdate):
     try:
         # Update Anthropic key if provided
         if settings.anthropic_key:
-            anthropic_client = Anthropic(api_key=settings.anthropic_key)
+            anthropic_client = AsyncAnthropic(api_key=settings.anthropic_key, http_client=ai_http_client)
             settings_store["anthropic_key_set"] = True
             print("✅ Anthropic API key actualizada")
 
         # Update OpenAI key if provided
         if settings.openai_key:
-            openai_client = OpenAI(api_key=settings.openai_key)
+            openai_client = AsyncOpenAI(api_key=settings.openai_key, http_client=ai_http_client)
             settings_store["openai_key_set"] = True
             print("✅ OpenAI API key actualizada")
 
@@ -193,9 +208,9 @@ async def analyze_fields_with_ai(data_preview: list, columns: list, filename: st
         return {"detected_fields": {}, "data_type": "unknown", "summary": "AI no disponible", "recommended_category": "general"}
 
     try:
-        sample_data = json.dumps(data_preview[:5], ensure_ascii=False, indent=2)
+        sample_data = orjson.dumps(data_preview[:5], default=str, option=orjson.OPT_INDENT_2).decode()
 
-        response = openai_client.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {
@@ -239,7 +254,7 @@ Analiza y mapea estos campos."""
                 result = result[4:]
         result = result.strip()
 
-        return json.loads(result)
+        return orjson.loads(result)
     except Exception as e:
         print(f"Error en análisis AI: {e}")
         return {
@@ -522,7 +537,7 @@ async def analyze_document(doc_id: int, analysis_type: str = "general"):
         prompt = prompts.get(analysis_type, prompts["general"])
 
         # Llamar a OpenAI GPT-4
-        response = openai_client.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model="gpt-4o-mini",
             max_tokens=2000,
             messages=[
@@ -623,7 +638,7 @@ async def chat_with_julia(request: ChatRequest):
                     preview = doc.get('data', [])[:10]
                     if preview:
                         data_context += f"  Columnas: {', '.join(info['columns'])}\n"
-                        data_context += f"  Muestra de datos: {json.dumps(preview[:5], ensure_ascii=False)}\n"
+                        data_context += f"  Muestra de datos: {orjson.dumps(preview[:5], default=str).decode()}\n"
 
         # System prompt para Julia
         system_prompt = f"""Eres Julia, una asistente experta en analisis financiero para restaurantes Little Caesars en Mexico.
@@ -664,7 +679,7 @@ Usa emojis con moderacion para hacer las respuestas mas amigables.
 
         # Llamar al AI provider seleccionado
         if current_provider == "anthropic":
-            response = anthropic_client.messages.create(
+            response = await anthropic_client.messages.create(
                 model="claude-sonnet-4-20250514",
                 max_tokens=1500,
                 system=system_prompt,
@@ -675,7 +690,7 @@ Usa emojis con moderacion para hacer las respuestas mas amigables.
         else:
             # OpenAI
             openai_messages = [{"role": "system", "content": system_prompt}] + chat_messages
-            response = openai_client.chat.completions.create(
+            response = await openai_client.chat.completions.create(
                 model="gpt-4o-mini",
                 max_tokens=1500,
                 temperature=0.7,
@@ -3,35 +3,73 @@ CICLOPS Backend - Producción con PostgreSQL
 API para análisis financiero de Little Caesars
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Query, Request, Header, status, Body
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Query, Request, Header, status, Body, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.httpsredirect import HTTPSRedirectMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import RedirectResponse, HTMLResponse, Response, StreamingResponse, ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from starlette.middleware.base import BaseHTTPMiddleware
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
-from openai import OpenAI
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import func, desc, select, delete, update, case, text, literal, literal_column, null, union_all, type_coerce, String, JSON
+from openai import AsyncOpenAI, APIConnectionError as OpenAIConnectionError
+import httpx
 import pandas as pd
 import numpy as np
-import json
+import openpyxl
+import asyncio
+import orjson
 import os
 import math
+import random
+import hashlib
+import hmac
+import shutil
+import tempfile
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
 from dotenv import load_dotenv
 from typing import Optional, List
 import traceback
-import pdfplumber
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+try:
+    # Argon2id para hashes nuevos; sin argon2-cffi se sigue usando bcrypt
+    from argon2 import PasswordHasher
+    from argon2.exceptions import VerificationError, InvalidHashError
+except ImportError:
+    PasswordHasher = None
+try:
+    import redis.asyncio as aioredis  # Rate limit compartido entre workers (si hay REDIS_URL)
+except ImportError:
+    aioredis = None
+try:
+    import pyarrow as pa  # Parquet para los datos raw de Excel/CSV
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+try:
+    import python_calamine  # Lector de Excel en Rust (engine="calamine" de pandas)
+except ImportError:
+    python_calamine = None
 import re
 from datetime import datetime, timedelta
+from email.utils import formatdate
 from jose import JWTError, jwt
-from passlib.context import CryptContext
+import bcrypt
 
-from .database import engine, get_db, Base
+from .database import (
+    engine, get_db, SessionLocal, Base, IS_SQLITE,
+    add_missing_columns, update_foreign_key_cascades, create_missing_indexes,
+    disable_statement_timeout, index_ready
+)
 from . import db_models as models
 from . import schemas
-from collections import defaultdict
+from .pdf_worker import extract_pdf_pages, pdf_page_count
+from collections import defaultdict, deque, OrderedDict
 import time
 import logging
 
@@ -48,6 +86,8 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 audit_logger = logging.getLogger("audit")
+# Mensajes de rutas calientes (auth, IA): formato %-style, solo se arma si el nivel lo permite
+logger = logging.getLogger(__name__)
 
 
 def log_audit(action: str, user_id: str = None, ip: str = None, details: str = None):
@@ -66,46 +106,167 @@ def log_audit(action: str, user_id: str = None, ip: str = None, details: str = N
 # RATE LIMITER SIMPLE (en memoria)
 # ============================================
 class RateLimiter:
-    """Limitador de tasa para prevenir ataques de fuerza bruta"""
-    def __init__(self, max_requests: int = 5, window_seconds: int = 60):
+    """
+    Limitador de tasa para prevenir ataques de fuerza bruta.
+    Ventana deslizante con un deque por identificador: los timestamps vencidos
+    salen por la izquierda (O(1) amortizado) en lugar de reconstruir la lista.
+    En memoria por proceso: con varios workers cada uno cuenta por separado;
+    check() usa Redis (si hay REDIS_URL) para contar entre todos los workers.
+    """
+    def __init__(self, name: str, max_requests: int = 5, window_seconds: int = 60):
+        self.name = name
         self.max_requests = max_requests
         self.window_seconds = window_seconds
-        self.requests = defaultdict(list)
+        self.requests = defaultdict(deque)
+        self._next_sweep = time.monotonic() + window_seconds
+
+    def _prune(self, timestamps: deque, now: float):
+        while timestamps and now - timestamps[0] >= self.window_seconds:
+            timestamps.popleft()
+
+    def _sweep(self, now: float):
+        """Una vez por ventana, olvida identificadores sin requests recientes"""
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.window_seconds
+        for identifier in [i for i, ts in self.requests.items() if not ts or now - ts[-1] >= self.window_seconds]:
+            del self.requests[identifier]
 
     def is_allowed(self, identifier: str) -> bool:
         """Verifica si el identificador puede hacer otra request"""
-        now = time.time()
-        # Limpiar requests viejas
-        self.requests[identifier] = [
-            req_time for req_time in self.requests[identifier]
-            if now - req_time < self.window_seconds
-        ]
+        now = time.monotonic()
+        self._sweep(now)
+        timestamps = self.requests[identifier]
+        self._prune(timestamps, now)
         # Verificar límite
-        if len(self.requests[identifier]) >= self.max_requests:
+        if len(timestamps) >= self.max_requests:
             return False
-        self.requests[identifier].append(now)
+        timestamps.append(now)
         return True
 
     def get_retry_after(self, identifier: str) -> int:
         """Retorna segundos hasta que pueda intentar de nuevo"""
-        if not self.requests[identifier]:
+        timestamps = self.requests.get(identifier)
+        if not timestamps:
             return 0
-        oldest = min(self.requests[identifier])
-        return max(0, int(self.window_seconds - (time.time() - oldest)))
+        now = time.monotonic()
+        self._prune(timestamps, now)
+        if not timestamps:
+            return 0
+        return max(0, int(self.window_seconds - (now - timestamps[0])))
+
+    async def check(self, identifier: str) -> int:
+        """
+        Registra un intento. Retorna 0 si se permite o los segundos a esperar.
+        Con Redis es ventana fija: SET NX con expiración + INCR + TTL en un solo
+        round-trip (atómico entre workers y sobrevive reinicios). Si Redis
+        falla se cuenta en memoria para no dejar el endpoint sin límite.
+        """
+        if rate_limit_redis is not None:
+            key = f"rl:{self.name}:{identifier}"
+            try:
+                async with rate_limit_redis.pipeline(transaction=True) as pipe:
+                    pipe.set(key, 0, ex=self.window_seconds, nx=True)
+                    pipe.incr(key)
+                    pipe.ttl(key)
+                    _, count, ttl = await pipe.execute()
+                return 0 if count <= self.max_requests else max(1, ttl)
+            except Exception as e:
+                logger.warning("Rate limit en Redis no disponible, se cuenta en memoria: %s", e)
+        if self.is_allowed(identifier):
+            return 0
+        return max(1, self.get_retry_after(identifier))
+
 
+# Redis es opcional: sin REDIS_URL (o sin el paquete) cada worker cuenta en memoria
+REDIS_URL = os.getenv("REDIS_URL")
+rate_limit_redis = None
+if aioredis is not None and REDIS_URL:
+    rate_limit_redis = aioredis.Redis.from_url(
+        REDIS_URL, max_connections=50, socket_timeout=0.5, socket_connect_timeout=0.5
+    )
 
 # Rate limiters para diferentes endpoints
-login_limiter = RateLimiter(max_requests=5, window_seconds=60)      # 5 intentos por minuto
-upload_limiter = RateLimiter(max_requests=10, window_seconds=60)    # 10 uploads por minuto
-chat_limiter = RateLimiter(max_requests=20, window_seconds=60)      # 20 chats por minuto
+login_limiter = RateLimiter("login", max_requests=5, window_seconds=60)      # 5 intentos por minuto
+upload_limiter = RateLimiter("upload", max_requests=10, window_seconds=60)   # 10 uploads por minuto
+chat_limiter = RateLimiter("chat", max_requests=20, window_seconds=60)       # 20 chats por minuto
+
+
+# ============================================
+# CACHE TTL SIMPLE (en memoria)
+# ============================================
+class TTLResponseCache:
+    """
+    Cache de respuestas de endpoints que el frontend consulta seguido
+    (dashboard, vault). Un lock por llave evita que varias requests
+    simultáneas recalculen lo mismo cuando expira.
+    """
+    def __init__(self, ttl_seconds: float = 10):
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}
+        self.locks = defaultdict(asyncio.Lock)
+
+    async def get_or_compute(self, key, compute):
+        """Retorna el valor cacheado o ejecuta compute() y lo guarda"""
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        async with self.locks[key]:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            # compute() hace consultas síncronas: se corre en un hilo
+            value = await asyncio.to_thread(compute)
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            return value
+
+    def clear(self):
+        """Invalida todo (después de confirmar o borrar documentos)"""
+        self.entries.clear()
+
+
+dashboard_cache = TTLResponseCache(ttl_seconds=10)
+
+
+def dedupe_monthly_summaries():
+    """
+    Deja una sola fila (la última insertada) por (store_id, period) en
+    monthly_summaries para que se pueda construir uq_ms_store_period en
+    bases creadas antes del índice. No hace nada si el índice ya existe.
+    """
+    if index_ready("monthly_summaries", "uq_ms_store_period"):
+        return
+    summaries = models.MonthlySummary.__table__
+    keep = select(func.max(summaries.c.id)).group_by(summaries.c.store_id, summaries.c.period)
+    with engine.begin() as conn:
+        disable_statement_timeout(conn)
+        # El índice único admite varios NULL: esas filas no se tocan
+        result = conn.execute(delete(summaries).where(
+            summaries.c.store_id.is_not(None),
+            summaries.c.period.is_not(None),
+            summaries.c.id.not_in(keep)
+        ))
+    if result.rowcount:
+        print(f"🧹 {result.rowcount} resúmenes duplicados eliminados de monthly_summaries")
+
 
 # Crear tablas
 Base.metadata.create_all(bind=engine)
+add_missing_columns()
+update_foreign_key_cascades()
+dedupe_monthly_summaries()
+create_missing_indexes()
+# upsert_monthly_summaries (ON CONFLICT store_id, period) depende de este
+# índice: sin él cada confirmación fallaría, mejor no arrancar
+if not index_ready("monthly_summaries", "uq_ms_store_period"):
+    raise RuntimeError("Falta el índice único uq_ms_store_period (o es inválido) en monthly_summaries")
 
 app = FastAPI(
     title="CICLOPS API",
     description="API para análisis financiero de Little Caesars con Julia AI",
-    version="2.0.0"
+    version="2.0.0",
+    # orjson serializa todas las respuestas en Rust en lugar de json stdlib
+    default_response_class=ORJSONResponse
 )
 
 
@@ -171,35 +332,203 @@ app.add_middleware(
 # Configuración JWT
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "tu-secret-key-cambiar-en-produccion-123")
 ALGORITHM = "HS256"
+# Precalculados una vez: jose acepta la llave en bytes y compara el HMAC con
+# hmac.compare_digest (tiempo constante)
+SECRET_KEY_BYTES = SECRET_KEY.encode("utf-8")
+ALGORITHMS_LIST = [ALGORITHM]
 print(f"🔐 JWT Secret Key configurada: {SECRET_KEY[:10]}...{SECRET_KEY[-5:]}")
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 días
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing: Argon2id (t=2, m=19 MiB, p=1) para hashes nuevos, unas
+# decenas de ms en lugar de los ~250 ms de bcrypt con 12 rondas. Los hashes
+# bcrypt ($2b$, incluidos los que generaba passlib) se siguen verificando y se
+# re-hashean a Argon2id en el siguiente login exitoso
+BCRYPT_ROUNDS = 12
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1) if PasswordHasher else None
 
 # Security scheme
 security = HTTPBearer(auto_error=False)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
+    if hashed_password.startswith("$argon2"):
+        if password_hasher is None:
+            return False
+        try:
+            return password_hasher.verify(hashed_password, plain_password)
+        except (VerificationError, InvalidHashError):
+            return False
     # bcrypt tiene límite de 72 bytes
-    return pwd_context.verify(plain_password[:72], hashed_password)
+    try:
+        return bcrypt.checkpw(plain_password.encode("utf-8")[:72], hashed_password.encode("utf-8"))
+    except ValueError:
+        # Hash con formato inválido
+        return False
 
 
 def get_password_hash(password: str) -> str:
+    if password_hasher is not None:
+        return password_hasher.hash(password)
     # bcrypt tiene límite de 72 bytes
-    return pwd_context.hash(password[:72])
+    return bcrypt.hashpw(password.encode("utf-8")[:72], bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode("utf-8")
+
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """True si el hash es bcrypt (o Argon2 con otros parámetros) y hay Argon2 disponible"""
+    if password_hasher is None:
+        return False
+    if not hashed_password.startswith("$argon2"):
+        return True
+    return password_hasher.check_needs_rehash(hashed_password)
+
+
+# El hash de contraseñas es CPU pura: en los endpoints async se corre en un
+# thread para no bloquear el event loop (bcrypt y argon2 liberan el GIL)
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await asyncio.to_thread(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    return await asyncio.to_thread(get_password_hash, password)
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     to_encode.update({"exp": expire})
-    token = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    print(f"🎫 Token creado con SECRET_KEY: {SECRET_KEY[:10]}...")
+    token = jwt.encode(to_encode, SECRET_KEY_BYTES, algorithm=ALGORITHM)
+    logger.debug("🎫 Token creado para sub=%s", data.get("sub"))
     return token
 
 
+# Payloads de tokens ya verificados: {sha256(token): (vence, payload)}. Un cliente
+# reusa el mismo token en cada request; se evita repetir la verificación HMAC.
+# La llave es el hash (no se guardan tokens en claro), solo se guardan tokens
+# válidos y cada entrada vence a los JWT_CACHE_TTL_SECONDS o con el "exp" del token
+JWT_CACHE_MAX_SIZE = 10000
+JWT_CACHE_TTL_SECONDS = 30
+_jwt_payload_cache = {}
+
+
+def decode_access_token(token: str) -> dict:
+    """jwt.decode con cache de payloads verificados. Lanza JWTError si no es válido."""
+    key = hashlib.sha256(token.encode()).digest()
+    now = time.time()
+    cached = _jwt_payload_cache.get(key)
+    if cached is not None:
+        if cached[0] > now:
+            return cached[1]
+        _jwt_payload_cache.pop(key, None)
+
+    logger.debug("🔍 Verificando token: %s...", token[:20])
+    payload = jwt.decode(token, SECRET_KEY_BYTES, algorithms=ALGORITHMS_LIST)
+    if isinstance(payload.get("exp"), (int, float)):
+        if len(_jwt_payload_cache) >= JWT_CACHE_MAX_SIZE:
+            # Sacar el más viejo (los dict conservan orden de inserción)
+            _jwt_payload_cache.pop(next(iter(_jwt_payload_cache)), None)
+        _jwt_payload_cache[key] = (min(payload["exp"], now + JWT_CACHE_TTL_SECONDS), payload)
+    return payload
+
+
+# Usuarios activos ya consultados: {user_id: (expira, datos)}. TTL corto para
+# que desactivar un usuario o cambiar su rol se refleje en segundos.
+USER_CACHE_TTL_SECONDS = 30
+USER_CACHE_MAX_SIZE = 5000
+_user_cache = {}
+
+
+def _put_user_cache(cache: dict, user_id: int, value):
+    """Guarda (expira, valor) sacando la entrada más vieja si el cache está lleno"""
+    cache.pop(user_id, None)
+    if len(cache) >= USER_CACHE_MAX_SIZE:
+        cache.pop(next(iter(cache)), None)
+    cache[user_id] = (time.monotonic() + USER_CACHE_TTL_SECONDS, value)
+
+
+def load_active_user(db: Session, user_id: int) -> Optional[dict]:
+    """Datos del usuario activo (cacheados USER_CACHE_TTL_SECONDS); None si no existe o está inactivo"""
+    cached = _user_cache.get(user_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return dict(cached[1])
+
+    # Solo las columnas que se usan (sin hashed_password ni timestamps)
+    user = db.execute(
+        select(
+            models.User.id, models.User.email, models.User.name,
+            models.User.role, models.User.is_active
+        ).where(models.User.id == user_id)
+    ).first()
+    if not user or not user.is_active:
+        _user_cache.pop(user_id, None)
+        return None
+
+    user_data = {
+        "id": user.id,
+        "uid": str(user.id),  # Compatibilidad con código existente
+        "email": user.email,
+        "name": user.name,
+        "role": user.role
+    }
+    _put_user_cache(_user_cache, user_id, user_data)
+    return dict(user_data)
+
+
+def user_token_claims(user) -> dict:
+    """
+    Claims del JWT: id más email/nombre/rol, firmados con el token, para que
+    get_current_user no tenga que leer el perfil de la base en cada request.
+    El rol del claim es informativo: el que vale es el de la base (user_role).
+    """
+    return {"sub": str(user.id), "email": user.email, "name": user.name, "role": user.role}
+
+
+# Rol vigente por usuario: {user_id: (expira, rol o None si está inactivo)}.
+# Es lo único que se consulta para tokens con perfil, así desactivar o
+# cambiar el rol de un usuario aplica en USER_CACHE_TTL_SECONDS y no al
+# expirar el token.
+_user_role_cache = {}
+
+
+def user_role(db: Session, user_id: int) -> Optional[str]:
+    """Rol actual del usuario; None si no existe o está inactivo"""
+    cached = _user_role_cache.get(user_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    # Misma consulta por PK que antes solo leía is_active
+    row = db.execute(
+        select(models.User.is_active, models.User.role).where(models.User.id == user_id)
+    ).first()
+    role = row.role if row is not None and row.is_active else None
+    _put_user_cache(_user_role_cache, user_id, role)
+    return role
+
+
+def user_from_token(db: Session, payload: dict) -> Optional[dict]:
+    """Datos del usuario a partir del payload verificado; None si está inactivo"""
+    user_id = int(payload["sub"])
+    if "role" not in payload:
+        # Tokens emitidos antes de incluir el perfil en los claims
+        return load_active_user(db, user_id)
+    role = user_role(db, user_id)
+    if role is None:
+        return None
+    return {
+        "id": user_id,
+        "uid": str(user_id),  # Compatibilidad con código existente
+        "email": payload.get("email"),
+        "name": payload.get("name"),
+        "role": role
+    }
+
+
+def invalidate_user_cache(user_id: int):
+    global _code_login_user
+    _user_cache.pop(user_id, None)
+    _user_role_cache.pop(user_id, None)
+    if _code_login_user is not None and _code_login_user[1]["id"] == user_id:
+        _code_login_user = None
+
+
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
@@ -214,33 +543,22 @@ async def get_current_user(
 
     token = credentials.credentials
     try:
-        print(f"🔍 Verificando token: {token[:20]}...")
-        print(f"🔐 Usando SECRET_KEY: {SECRET_KEY[:10]}...")
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        print(f"✅ Token válido, payload: {payload}")
-        user_id_str = payload.get("sub")
-        if user_id_str is None:
+        payload = decode_access_token(token)
+        if payload.get("sub") is None:
             raise HTTPException(status_code=401, detail="Token inválido")
-        user_id = int(user_id_str)
     except JWTError as e:
-        print(f"❌ Error JWT: {e}")
+        logger.info("❌ Error JWT: %s", e)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Token inválido o expirado",
             headers={"WWW-Authenticate": "Bearer"}
         )
 
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    if not user or not user.is_active:
+    user = user_from_token(db, payload)
+    if user is None:
         raise HTTPException(status_code=401, detail="Usuario no encontrado o inactivo")
 
-    return {
-        "id": user.id,
-        "uid": str(user.id),  # Compatibilidad con código existente
-        "email": user.email,
-        "name": user.name,
-        "role": user.role
-    }
+    return user
 
 
 async def get_optional_user(
@@ -252,23 +570,11 @@ async def get_optional_user(
         return None
 
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id_str = payload.get("sub")
-        if user_id_str is None:
-            return None
-        user_id = int(user_id_str)
-
-        user = db.query(models.User).filter(models.User.id == user_id).first()
-        if not user or not user.is_active:
+        payload = decode_access_token(credentials.credentials)
+        if payload.get("sub") is None:
             return None
 
-        return {
-            "id": user.id,
-            "uid": str(user.id),
-            "email": user.email,
-            "name": user.name,
-            "role": user.role
-        }
+        return user_from_token(db, payload)
     except JWTError:
         return None
 
@@ -289,9 +595,33 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 AI_PROVIDER = os.getenv("AI_PROVIDER", "anthropic")  # Default to Anthropic/Claude
 
+# Conexiones HTTP compartidas por los clientes de AI: pool amplio con keep-alive
+# largo (y HTTP/2 si está h2) para no repetir TCP+TLS en cada llamada
+try:
+    import h2  # noqa: F401
+    AI_HTTP2 = True
+except ImportError:
+    AI_HTTP2 = False
+AI_HTTP_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("AI_HTTP_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("AI_HTTP_MAX_KEEPALIVE", "50")),
+    keepalive_expiry=120
+)
+# Respuestas largas (max_tokens=2000) pueden pasar de 60 s
+AI_HTTP_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+ai_http_client = httpx.AsyncClient(http2=AI_HTTP2, limits=AI_HTTP_LIMITS, timeout=AI_HTTP_TIMEOUT)
+
+# Reintentos: los SDKs no reintentan por su cuenta (max_retries=0); lo hace
+# call_ai_with_fallback, que ante un 429 cambia de proveedor sin esperar
+AI_MAX_ATTEMPTS = int(os.getenv("AI_MAX_ATTEMPTS", "3"))
+AI_TRANSIENT_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+AI_DEFAULT_COOLDOWN_SECONDS = 20
+# Errores de red/timeout (sin status HTTP); se agrega el de Anthropic si está instalado
+AI_CONNECTION_ERRORS = (OpenAIConnectionError,)
+
 # Inicializar OpenAI si hay key
 if OPENAI_API_KEY:
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=ai_http_client, max_retries=0)
     print("✅ OpenAI API configurada")
 else:
     print("⚠️ OPENAI_API_KEY no encontrada")
@@ -299,8 +629,11 @@ else:
 # Inicializar Anthropic si hay key
 try:
     import anthropic
+    AI_CONNECTION_ERRORS += (anthropic.APIConnectionError,)
     if ANTHROPIC_API_KEY:
-        anthropic_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+        anthropic_client = anthropic.AsyncAnthropic(
+            api_key=ANTHROPIC_API_KEY, http_client=ai_http_client, max_retries=0
+        )
         print("✅ Anthropic API configurada")
     else:
         print("⚠️ ANTHROPIC_API_KEY no encontrada")
@@ -308,81 +641,471 @@ except ImportError:
     print("⚠️ anthropic module not installed")
 
 
+async def warm_ai_connections():
+    """
+    Abre la conexión (TCP + TLS) con cada proveedor al arrancar para que la
+    primera consulta real no pague el handshake. Cualquier respuesta sirve.
+    """
+    for client in (openai_client, anthropic_client):
+        if client is None:
+            continue
+        try:
+            await ai_http_client.head(str(client.base_url))
+        except Exception as e:
+            print(f"⚠️ No se pudo precalentar {client.base_url}: {e}")
+
+
+@app.on_event("startup")
+async def start_ai_warmup():
+    # En segundo plano: no retrasar el arranque si un proveedor tarda
+    app.state.ai_warmup_task = asyncio.create_task(warm_ai_connections())
+
+
+@app.on_event("shutdown")
+async def close_ai_http_client():
+    await ai_http_client.aclose()
+    if rate_limit_redis is not None:
+        await rate_limit_redis.aclose()
+
+
 # ============================================
 # HELPER DE IA CON FALLBACK
 # ============================================
 
-def call_ai_with_fallback(messages: list, max_tokens: int = 1500, temperature: float = 0.7) -> dict:
+def to_anthropic_messages(messages: list) -> tuple:
+    """Convierte mensajes de OpenAI format a Anthropic format: (system, messages)"""
+    # Caso normal: el prompt de sistema va primero y el resto ya trae solo
+    # role/content, así que basta un slice en lugar de copiar cada mensaje
+    rest = messages[1:]
+    if messages and messages[0]["role"] == "system" and all(m["role"] != "system" for m in rest):
+        return messages[0]["content"], rest
+
+    system_msg = ""
+    anthropic_messages = []
+    for msg in messages:
+        if msg["role"] == "system":
+            system_msg = msg["content"]
+        else:
+            anthropic_messages.append({
+                "role": msg["role"],
+                "content": msg["content"]
+            })
+    return system_msg, anthropic_messages
+
+
+# {proveedor: time.monotonic() hasta el que no se le envían llamadas} tras un 429
+ai_cooldown_until = {}
+
+
+def ai_provider_should_wait(provider_name: str) -> bool:
+    return ai_cooldown_until.get(provider_name, 0) > time.monotonic()
+
+
+def start_ai_cooldown(provider_name: str, error: Exception):
+    """Pausa al proveedor lo que indique Retry-After (o AI_DEFAULT_COOLDOWN_SECONDS)"""
+    retry_after = None
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            retry_after = float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    ai_cooldown_until[provider_name] = time.monotonic() + (retry_after or AI_DEFAULT_COOLDOWN_SECONDS)
+    logger.warning("⏳ [IA] %s en pausa %.0fs por rate limit", provider_name, retry_after or AI_DEFAULT_COOLDOWN_SECONDS)
+
+
+def is_transient_ai_error(error: Exception) -> bool:
+    """Rate limit, sobrecarga o red: vale la pena reintentar"""
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code in AI_TRANSIENT_STATUS
+    return isinstance(error, AI_CONNECTION_ERRORS)
+
+
+def record_ai_failure(provider_name: str, error: Exception) -> bool:
+    """Registra el fallo de un proveedor; retorna True si fue transitorio"""
+    if getattr(error, "status_code", None) == 429:
+        start_ai_cooldown(provider_name, error)
+    return is_transient_ai_error(error)
+
+
+def ai_providers() -> list:
     """
-    Llama a la IA con fallback automático entre proveedores.
-    Intenta primero con el proveedor configurado, luego con el otro.
-    Retorna: {"response": str, "tokens_used": int, "provider": str}
+    Proveedores configurados en orden: primero el de AI_PROVIDER, luego el otro.
+    Se omiten los que están en pausa por rate limit, salvo que lo estén todos.
     """
-    errors = []
-
-    # Determinar orden de proveedores
     if AI_PROVIDER == "anthropic" and anthropic_client:
         providers = [("anthropic", anthropic_client), ("openai", openai_client)]
     else:
         providers = [("openai", openai_client), ("anthropic", anthropic_client)]
+    providers = [(name, client) for name, client in providers if client]
+    ready = [(name, client) for name, client in providers if not ai_provider_should_wait(name)]
+    return ready or providers
 
-    for provider_name, client in providers:
-        if not client:
-            continue
 
-        try:
-            if provider_name == "openai":
-                response = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=messages,
-                    max_tokens=max_tokens,
-                    temperature=temperature
-                )
-                return {
-                    "response": response.choices[0].message.content,
-                    "tokens_used": response.usage.total_tokens,
-                    "provider": "openai"
-                }
-            else:  # anthropic
-                # Convertir mensajes de OpenAI format a Anthropic format
-                system_msg = ""
-                anthropic_messages = []
-                for msg in messages:
-                    if msg["role"] == "system":
-                        system_msg = msg["content"]
-                    else:
-                        anthropic_messages.append({
-                            "role": msg["role"],
-                            "content": msg["content"]
-                        })
-
-                response = client.messages.create(
-                    model="claude-sonnet-4-20250514",
-                    max_tokens=max_tokens,
-                    system=system_msg,
-                    messages=anthropic_messages
-                )
-                return {
-                    "response": response.content[0].text,
-                    "tokens_used": response.usage.input_tokens + response.usage.output_tokens,
-                    "provider": "anthropic"
-                }
+async def _call_ai_provider(provider_name: str, client, messages: list, max_tokens: int, temperature: float) -> dict:
+    if provider_name == "openai":
+        response = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        return {
+            "response": response.choices[0].message.content,
+            "tokens_used": response.usage.total_tokens,
+            "provider": "openai"
+        }
 
-        except Exception as e:
-            error_msg = f"[IA ERROR] {provider_name} falló: {str(e)}"
-            print(f"⚠️ {error_msg}")
-            errors.append(error_msg)
-            continue
+    system_msg, anthropic_messages = to_anthropic_messages(messages)
+    response = await client.messages.create(
+        model="claude-sonnet-4-20250514",
+        max_tokens=max_tokens,
+        system=system_msg,
+        messages=anthropic_messages
+    )
+    return {
+        "response": response.content[0].text,
+        "tokens_used": response.usage.input_tokens + response.usage.output_tokens,
+        "provider": "anthropic"
+    }
+
+
+async def call_ai_with_fallback(messages: list, max_tokens: int = 1500, temperature: float = 0.7) -> dict:
+    """
+    Llama a la IA con fallback automático entre proveedores.
+    Intenta primero con el proveedor configurado, luego con el otro. Si todos
+    fallan por algo transitorio (429/5xx/red) repite la ronda hasta
+    AI_MAX_ATTEMPTS veces con backoff exponencial y jitter.
+    Retorna: {"response": str, "tokens_used": int, "provider": str}
+    """
+    errors = []
+
+    for attempt in range(AI_MAX_ATTEMPTS):
+        transient = False
+        for provider_name, client in ai_providers():
+            try:
+                return await _call_ai_provider(provider_name, client, messages, max_tokens, temperature)
+            except Exception as e:
+                error_msg = f"[IA ERROR] {provider_name} falló: {str(e)}"
+                logger.warning("⚠️ %s", error_msg)
+                errors.append(error_msg)
+                transient = record_ai_failure(provider_name, e) or transient
+
+        if not transient or attempt == AI_MAX_ATTEMPTS - 1:
+            break
+        await asyncio.sleep(random.uniform(1, 2) * 2 ** attempt)
 
     # Si llegamos aquí, ambos fallaron
     error_detail = " | ".join(errors) if errors else "No hay proveedores de IA configurados"
-    print(f"❌ [IA CRÍTICO] Todos los proveedores fallaron: {error_detail}")
+    logger.error("❌ [IA CRÍTICO] Todos los proveedores fallaron: %s", error_detail)
     raise HTTPException(
         status_code=503,
         detail=f"Servicio de IA no disponible. Por favor intenta más tarde. ({error_detail})"
     )
 
 
+# Máximo de tokens de documentos del vault en el prompt de /chat
+CHAT_CONTEXT_TOKEN_BUDGET = 6000
+# Máximo de caracteres del contexto extra que manda el cliente en /chat
+CHAT_BASE_CONTEXT_MAX_CHARS = 12000
+_token_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Tokens de gpt-4o-mini (o200k_base); sin tiktoken, estimado de ~4 caracteres por token"""
+    global _token_encoding
+    if tiktoken is not None and _token_encoding is None:
+        try:
+            _token_encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(f"⚠️ tiktoken no disponible, se estiman tokens: {e}")
+            _token_encoding = False
+    if _token_encoding:
+        return len(_token_encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+def dumps_json(obj, indent: bool = False) -> str:
+    """json.dumps con orjson (UTF-8 sin escapar, valores no serializables con str)"""
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, default=str, option=option).decode()
+
+
+def _sse_event(payload: dict) -> str:
+    return f"data: {dumps_json(payload)}\n\n"
+
+
+def save_analysis_record(**fields):
+    """Guarda un Analysis con su propia sesión (la del request ya cerró al terminar un stream)"""
+    db = SessionLocal()
+    try:
+        db.add(models.Analysis(**fields))
+        db.commit()
+    finally:
+        db.close()
+
+
+async def _stream_ai_provider(provider_name: str, client, messages: list, usage: dict,
+                             max_tokens: int, temperature: float):
+    """Fragmentos de texto de un proveedor; al terminar deja tokens_used en usage"""
+    if provider_name == "anthropic":
+        system_msg, anthropic_messages = to_anthropic_messages(messages)
+        async with client.messages.stream(
+            model="claude-sonnet-4-20250514",
+            max_tokens=max_tokens,
+            system=system_msg,
+            messages=anthropic_messages
+        ) as stream:
+            async for delta in stream.text_stream:
+                yield delta
+            final = await stream.get_final_message()
+        usage["tokens_used"] = final.usage.input_tokens + final.usage.output_tokens
+    else:
+        stream = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True
+        )
+        fragments = 0
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                fragments += 1
+                yield delta
+        # El stream no reporta usage: un fragmento ~ un token de salida
+        usage["tokens_used"] = fragments
+
+
+async def stream_ai_with_fallback(messages: list, on_complete, max_tokens: int = 1500, temperature: float = 0.7):
+    """
+    Versión streaming (Server-Sent Events) de call_ai_with_fallback.
+    Emite {"delta": texto} por fragmento y al final {"done": true, ...};
+    on_complete(texto_completo, tokens_used) se llama al cerrar el stream.
+    Si un proveedor falla antes del primer fragmento se intenta con el otro;
+    a mitad del stream ya no se puede cambiar y se emite {"error"}.
+    """
+    errors = []
+    for provider_name, client in ai_providers():
+        chunks = []
+        usage = {}
+        try:
+            async for delta in _stream_ai_provider(provider_name, client, messages, usage, max_tokens, temperature):
+                chunks.append(delta)
+                yield _sse_event({"delta": delta})
+        except Exception as e:
+            error_msg = f"[IA STREAM] {provider_name} falló: {str(e)}"
+            logger.warning("⚠️ %s", error_msg)
+            record_ai_failure(provider_name, e)
+            if chunks:
+                yield _sse_event({"error": str(e)})
+                return
+            errors.append(error_msg)
+            continue
+
+        text = "".join(chunks)
+        try:
+            # on_complete escribe en la base: fuera del event loop
+            await asyncio.to_thread(on_complete, text, usage["tokens_used"])
+        except Exception as e:
+            logger.error("❌ [IA STREAM] Error guardando respuesta: %s", e)
+        yield _sse_event({"done": True, "tokens_used": usage["tokens_used"], "provider": provider_name})
+        return
+
+    error_detail = " | ".join(errors) if errors else "No hay proveedores de IA configurados"
+    logger.error("❌ [IA CRÍTICO] Todos los proveedores fallaron: %s", error_detail)
+    yield _sse_event({"error": error_detail})
+
+
+# Sin esto un proxy (nginx/Railway) puede acumular el stream y se pierde el primer byte temprano
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def sse_response(events) -> StreamingResponse:
+    return StreamingResponse(events, media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+def wants_event_stream(http_request: Request, stream: bool) -> bool:
+    """Streaming con ?stream=true o con Accept: text/event-stream (EventSource/fetch)"""
+    return stream or "text/event-stream" in http_request.headers.get("accept", "")
+
+
+# ============================================
+# CACHE SEMÁNTICO DE RESPUESTAS DE IA
+# ============================================
+
+class SemanticResponseCache:
+    """
+    Respuestas recientes de la IA indexadas por el embedding de la pregunta.
+    Una pregunta equivalente ("¿cuáles son las ventas?" / "muéstrame los
+    ingresos") sobre el mismo contexto reutiliza la respuesta en lugar de
+    esperar 1-5 s al proveedor. Solo se compara dentro del mismo scope
+    (hash del prompt de sistema + historial), así que datos nuevos en el
+    vault nunca reciben una respuesta vieja. Un hit semántico además exige
+    las mismas entidades (tiendas, periodos, cifras): "ventas de Centro en
+    P9" y "ventas de Norte en P10" se parecen mucho pero no son la misma pregunta.
+    """
+    def __init__(self, threshold: float = 0.92, ttl_seconds: float = 300, max_entries: int = 512):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # {(scope, pregunta): (expira, embedding normalizado o None, entidades, respuesta)}, orden LRU
+        self.entries = OrderedDict()
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        for key in [k for k, entry in self.entries.items() if entry[0] <= now]:
+            del self.entries[key]
+
+    def get_exact(self, scope: str, question: str) -> Optional[dict]:
+        entry = self.entries.get((scope, question))
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        self.entries.move_to_end((scope, question))
+        return entry[3]
+
+    def find_similar(self, scope: str, embedding: np.ndarray, entities: frozenset = frozenset()) -> Optional[dict]:
+        """Mejor respuesta del scope con las mismas entidades y similitud coseno >= threshold"""
+        self._purge_expired()
+        candidates = [
+            (key, entry) for key, entry in self.entries.items()
+            if key[0] == scope and entry[1] is not None and entry[2] == entities
+        ]
+        if not candidates:
+            return None
+        # Vectores normalizados: el producto punto es la similitud coseno
+        scores = np.stack([entry[1] for _, entry in candidates]) @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        key, entry = candidates[best]
+        self.entries.move_to_end(key)
+        return entry[3]
+
+    def put(
+        self, scope: str, question: str, embedding: Optional[np.ndarray], response: dict,
+        entities: frozenset = frozenset()
+    ):
+        self.entries[(scope, question)] = (time.monotonic() + self.ttl_seconds, embedding, entities, response)
+        self.entries.move_to_end((scope, question))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+ai_response_cache = SemanticResponseCache(
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+)
+
+
+# Entidades de una pregunta que deben coincidir para reutilizar una respuesta
+_ENTITY_PERIOD_RE = re.compile(r'\bP0*(\d{1,2})\b', re.IGNORECASE)
+_ENTITY_NUMBER_RE = re.compile(r'\d+(?:[.,]\d+)*')
+_ENTITY_WORD_RE = re.compile(r'[^\W\d_]+')
+
+
+def question_entities(question: str, store_names: frozenset = frozenset()) -> frozenset:
+    """
+    Periodos (P9 = P09), meses, cifras, palabras con mayúscula (salvo la
+    primera) y nombres de tienda conocidos que aparecen en la pregunta.
+    """
+    lowered = question.lower()
+    entities = {f"p{int(n)}" for n in _ENTITY_PERIOD_RE.findall(question)}
+    entities.update(n.lstrip("0") or "0" for n in _ENTITY_NUMBER_RE.findall(question))
+    entities.update(m.group(0).lower() for m in _MONTHS_RE.finditer(question))
+    words = _ENTITY_WORD_RE.findall(question)
+    entities.update(word.lower() for word in words[1:] if word[0].isupper())
+    entities.update(
+        name for name in store_names
+        if re.search(rf'\b{re.escape(name)}\b', lowered)
+    )
+    return frozenset(entities)
+
+
+# Nombres de tienda del vault (en minúsculas) para question_entities: (expira, nombres)
+STORE_NAMES_TTL_SECONDS = 60
+_store_names_cache = (0.0, frozenset())
+
+
+def known_store_names(db: Session) -> frozenset:
+    """Nombres de tienda conocidos (documentos, resúmenes y catálogo), cacheados STORE_NAMES_TTL_SECONDS"""
+    global _store_names_cache
+    if _store_names_cache[0] > time.monotonic():
+        return _store_names_cache[1]
+    names = db.scalars(union_all(
+        select(models.Document.store_name).distinct(),
+        select(models.MonthlySummary.store_name).distinct(),
+        select(models.Store.name).distinct()
+    )).all()
+    store_names = frozenset(name.strip().lower() for name in names if name and name.strip())
+    _store_names_cache = (time.monotonic() + STORE_NAMES_TTL_SECONDS, store_names)
+    return store_names
+
+
+def ai_cache_scope(messages: list) -> str:
+    """Hash del contexto de una consulta (todo menos la pregunta final)"""
+    return hashlib.sha1(orjson.dumps(messages)).hexdigest()
+
+
+# Textos por llamada a /embeddings (la API acepta hasta 2048)
+EMBEDDING_BATCH_SIZE = 100
+
+
+async def embed_texts(texts: list) -> Optional[np.ndarray]:
+    """
+    Embeddings normalizados (una fila por texto) pidiendo EMBEDDING_BATCH_SIZE
+    textos por llamada en lugar de una llamada por texto.
+    None si no hay cliente o falla.
+    """
+    if not openai_client or not texts:
+        return None
+    try:
+        vectors = []
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            response = await openai_client.embeddings.create(
+                model="text-embedding-3-small",
+                input=[text[:8000] for text in texts[start:start + EMBEDDING_BATCH_SIZE]]
+            )
+            # La API puede no respetar el orden de entrada: se ordena por index
+            vectors.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1.0, norms)
+    except Exception as e:
+        print(f"⚠️ [CACHE IA] No se pudo generar embedding: {e}")
+        return None
+
+
+async def embed_text(text: str) -> Optional[np.ndarray]:
+    """Embedding normalizado de un solo texto; None si no hay cliente o falla"""
+    vectors = await embed_texts([text])
+    return vectors[0] if vectors is not None else None
+
+
+async def find_cached_ai_response(scope: str, question: str, entities: frozenset = frozenset()) -> tuple:
+    """
+    Busca primero la misma pregunta y luego una semánticamente equivalente
+    con las mismas entidades (question_entities).
+    Retorna (respuesta o None, embedding de la pregunta para guardarla después).
+    """
+    cached = ai_response_cache.get_exact(scope, question)
+    if cached is not None:
+        return cached, None
+    embedding = await embed_text(question)
+    if embedding is not None:
+        cached = ai_response_cache.find_similar(scope, embedding, entities)
+    return cached, embedding
+
+
+async def cached_sse_response(cached: dict):
+    """Respuesta cacheada con el mismo formato de eventos que stream_ai_with_fallback"""
+    yield _sse_event({"delta": cached["response"]})
+    yield _sse_event({"done": True, "tokens_used": 0, "provider": cached["provider"], "cached": True})
+
+
 # ============================================
 # AUTH ENDPOINTS
 # ============================================
@@ -391,14 +1114,14 @@ def call_ai_with_fallback(messages: list, max_tokens: int = 1500, temperature: f
 async def register(user_data: schemas.UserCreate, db: Session = Depends(get_db)):
     """Registra un nuevo usuario"""
     # Verificar si el email ya existe
-    existing = db.query(models.User).filter(models.User.email == user_data.email).first()
+    existing = db.scalars(select(models.User).where(models.User.email == user_data.email)).first()
     if existing:
         raise HTTPException(status_code=400, detail="El email ya está registrado")
 
     # Crear usuario
     user = models.User(
         email=user_data.email,
-        hashed_password=get_password_hash(user_data.password),
+        hashed_password=await get_password_hash_async(user_data.password),
         name=user_data.name,
         role="user"
     )
@@ -407,7 +1130,7 @@ async def register(user_data: schemas.UserCreate, db: Session = Depends(get_db))
     db.refresh(user)
 
     # Generar token
-    token = create_access_token(data={"sub": str(user.id)})
+    token = create_access_token(data=user_token_claims(user))
 
     return {
         "access_token": token,
@@ -418,14 +1141,19 @@ async def register(user_data: schemas.UserCreate, db: Session = Depends(get_db))
 
 # Código de acceso único (temporal)
 ACCESS_CODE = "LC-2026-X7K9M"
+ACCESS_CODE_BYTES = ACCESS_CODE.encode("utf-8")
+
+# Usuario genérico de /auth/code-login ya resuelto: (claims del JWT, datos para
+# la respuesta). Evita buscarlo por email en cada login; invalidate_user_cache lo limpia
+_code_login_user = None
 
 @app.post("/auth/code-login")
 async def code_login(request: Request, code: str = Body(..., embed=True), db: Session = Depends(get_db)):
     """Login con código de acceso único - Rate limited"""
     # Rate limiting por IP
     client_ip = request.headers.get("x-forwarded-for", request.client.host).split(",")[0].strip()
-    if not login_limiter.is_allowed(client_ip):
-        retry_after = login_limiter.get_retry_after(client_ip)
+    retry_after = await login_limiter.check(client_ip)
+    if retry_after:
         log_audit("LOGIN_RATE_LIMITED", ip=client_ip, details="Demasiados intentos")
         raise HTTPException(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
@@ -433,50 +1161,56 @@ async def code_login(request: Request, code: str = Body(..., embed=True), db: Se
             headers={"Retry-After": str(retry_after)}
         )
 
-    if code != ACCESS_CODE:
+    # Comparación en tiempo constante: no filtra por timing cuántos caracteres coinciden
+    if not hmac.compare_digest(code.encode("utf-8"), ACCESS_CODE_BYTES):
         log_audit("LOGIN_FAILED", ip=client_ip, details="Código incorrecto")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Código de acceso incorrecto"
         )
 
-    # Buscar o crear usuario genérico
-    user = db.query(models.User).filter(models.User.email == "admin@ciclops.mx").first()
-    if not user:
-        # Crear usuario admin si no existe
-        user = models.User(
-            email="admin@ciclops.mx",
-            name="Admin CICLOPS",
-            hashed_password=get_password_hash("temp-not-used"),
-            role="admin",
-            is_active=True
-        )
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-
-    token = create_access_token(data={"sub": str(user.id)})
-    log_audit("LOGIN_SUCCESS", user_id=str(user.id), ip=client_ip)
+    global _code_login_user
+    if _code_login_user is None:
+        # Buscar o crear usuario genérico
+        user = db.scalars(select(models.User).where(models.User.email == "admin@ciclops.mx")).first()
+        if not user:
+            # Crear usuario admin si no existe
+            user = models.User(
+                email="admin@ciclops.mx",
+                name="Admin CICLOPS",
+                hashed_password=await get_password_hash_async("temp-not-used"),
+                role="admin",
+                is_active=True
+            )
+            db.add(user)
+            db.commit()
+            db.refresh(user)
 
-    return {
-        "access_token": token,
-        "token_type": "bearer",
-        "user": {
+        _code_login_user = (user_token_claims(user), {
             "id": user.id,
             "email": user.email,
             "name": user.name,
             "role": user.role,
             "is_active": user.is_active
-        }
+        })
+
+    claims, user_data = _code_login_user
+    token = create_access_token(data=claims)
+    log_audit("LOGIN_SUCCESS", user_id=str(user_data["id"]), ip=client_ip)
+
+    return {
+        "access_token": token,
+        "token_type": "bearer",
+        "user": dict(user_data)
     }
 
 
 @app.post("/auth/login", response_model=schemas.Token)
 async def login(user_data: schemas.UserLogin, db: Session = Depends(get_db)):
     """Inicia sesión y retorna token JWT"""
-    user = db.query(models.User).filter(models.User.email == user_data.email).first()
+    user = db.scalars(select(models.User).where(models.User.email == user_data.email)).first()
 
-    if not user or not verify_password(user_data.password, user.hashed_password):
+    if not user or not await verify_password_async(user_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Email o contraseña incorrectos"
@@ -485,7 +1219,14 @@ async def login(user_data: schemas.UserLogin, db: Session = Depends(get_db)):
     if not user.is_active:
         raise HTTPException(status_code=400, detail="Usuario desactivado")
 
-    token = create_access_token(data={"sub": str(user.id)})
+    # Migración gradual bcrypt -> Argon2id: solo aquí se tiene la contraseña en claro
+    if password_needs_rehash(user.hashed_password):
+        user.hashed_password = await get_password_hash_async(user_data.password)
+        db.commit()
+
+    token = create_access_token(data=user_token_claims(user))
+    # El login acaba de leer el usuario: la siguiente request lo vuelve a cargar fresco
+    invalidate_user_cache(user.id)
 
     return {
         "access_token": token,
@@ -497,8 +1238,8 @@ async def login(user_data: schemas.UserLogin, db: Session = Depends(get_db)):
 @app.get("/auth/me", response_model=schemas.UserResponse)
 async def get_me(current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
     """Retorna el usuario actual"""
-    user = db.query(models.User).filter(models.User.id == current_user["id"]).first()
-    return user
+    # Por PK: usa el identity map de la sesión antes de ir a la base
+    return db.get(models.User, current_user["id"])
 
 
 @app.post("/auth/setup-admin")
@@ -511,15 +1252,14 @@ async def setup_admin(user_data: schemas.UserCreate, db: Session = Depends(get_d
         # Forzar creación de tabla si no existe
         models.User.__table__.create(bind=engine, checkfirst=True)
 
-        # Solo permitir si no hay usuarios
-        user_count = db.query(models.User).count()
-        if user_count > 0:
+        # Solo permitir si no hay usuarios (LIMIT 1: no hace falta contar toda la tabla)
+        if db.scalar(select(models.User.id).limit(1)) is not None:
             raise HTTPException(status_code=400, detail="Ya existen usuarios. Use /auth/register")
 
         # Crear admin
         user = models.User(
             email=user_data.email,
-            hashed_password=get_password_hash(user_data.password),
+            hashed_password=await get_password_hash_async(user_data.password),
             name=user_data.name or "Admin",
             role="admin"
         )
@@ -527,7 +1267,8 @@ async def setup_admin(user_data: schemas.UserCreate, db: Session = Depends(get_d
         db.commit()
         db.refresh(user)
 
-        token = create_access_token(data={"sub": str(user.id)})
+        token = create_access_token(data=user_token_claims(user))
+        invalidate_user_cache(user.id)
         return {
             "access_token": token,
             "token_type": "bearer",
@@ -559,22 +1300,73 @@ async def api_root():
     }
 
 
-@app.get("/health")
-async def health_check(db: Session = Depends(get_db)):
-    doc_count = db.query(models.Document).count()
-    # Verificar usuarios
+def estimate_row_count(db: Session, model) -> int:
+    """
+    Conteo aproximado de filas. En PostgreSQL lee la estadística del planner
+    (O(1)) en lugar de recorrer la tabla; en SQLite hace count(*).
+    """
+    if engine.dialect.name == "postgresql":
+        estimate = db.scalar(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+            {"table": model.__tablename__}
+        )
+        # reltuples = -1 si la tabla nunca se ha analizado
+        if estimate is not None and estimate >= 0:
+            return estimate
+    return db.scalar(select(func.count()).select_from(model))
+
+
+# Conteos de /health: una tarea los refresca cada HEALTH_REFRESH_SECONDS para
+# que los probes del orquestador no toquen la base en cada llamada
+HEALTH_REFRESH_SECONDS = 30
+HEALTH_CACHE = {"ts": 0.0, "database": "connected", "documents_count": 0, "users_count": 0}
+
+
+def refresh_health_counts():
+    """Actualiza HEALTH_CACHE con su propia sesión"""
+    db = SessionLocal()
     try:
-        user_count = db.query(models.User).count()
+        HEALTH_CACHE["documents_count"] = estimate_row_count(db, models.Document)
+        try:
+            HEALTH_CACHE["users_count"] = estimate_row_count(db, models.User)
+        except Exception as e:
+            HEALTH_CACHE["users_count"] = f"ERROR: {str(e)}"
+        HEALTH_CACHE["database"] = "connected"
     except Exception as e:
-        user_count = f"ERROR: {str(e)}"
+        HEALTH_CACHE["database"] = f"ERROR: {str(e)}"
+    finally:
+        db.close()
+        HEALTH_CACHE["ts"] = time.monotonic()
+
+
+async def health_refresh_loop():
+    while True:
+        await asyncio.to_thread(refresh_health_counts)
+        await asyncio.sleep(HEALTH_REFRESH_SECONDS)
+
+
+@app.on_event("startup")
+async def start_health_refresh():
+    # Guardar la referencia evita que el recolector cancele la tarea
+    app.state.health_refresh_task = asyncio.create_task(health_refresh_loop())
+
+
+@app.get("/health")
+async def health_check():
+    if not HEALTH_CACHE["ts"]:
+        # La tarea aún no termina su primera vuelta
+        await asyncio.to_thread(refresh_health_counts)
+    if HEALTH_CACHE["database"] != "connected":
+        # Igual que antes: si la base falla el probe no debe pasar
+        raise HTTPException(status_code=503, detail=HEALTH_CACHE["database"])
     return {
         "status": "healthy",
-        "database": "connected",
-        "users_count": user_count,
+        "database": HEALTH_CACHE["database"],
+        "users_count": HEALTH_CACHE["users_count"],
         "openai": "connected" if openai_client else "disabled",
         "anthropic": "connected" if anthropic_client else "disabled",
         "ai_provider": AI_PROVIDER,
-        "documents_count": doc_count
+        "documents_count": HEALTH_CACHE["documents_count"]
     }
 
 
@@ -614,8 +1406,9 @@ async def save_settings(
             return {"success": False, "error": "OpenAI key debe empezar con 'sk-'"}
         try:
             # Test the key
-            test_client = OpenAI(api_key=new_key)
+            test_client = AsyncOpenAI(api_key=new_key, http_client=ai_http_client, max_retries=0)
             openai_client = test_client
+            ai_cooldown_until.pop("openai", None)
             OPENAI_API_KEY = new_key
             os.environ["OPENAI_API_KEY"] = new_key
             messages.append("OpenAI API key actualizada")
@@ -629,8 +1422,9 @@ async def save_settings(
             return {"success": False, "error": "Anthropic key debe empezar con 'sk-ant-'"}
         try:
             import anthropic
-            test_client = anthropic.Anthropic(api_key=new_key)
+            test_client = anthropic.AsyncAnthropic(api_key=new_key, http_client=ai_http_client, max_retries=0)
             anthropic_client = test_client
+            ai_cooldown_until.pop("anthropic", None)
             ANTHROPIC_API_KEY = new_key
             os.environ["ANTHROPIC_API_KEY"] = new_key
             messages.append("Anthropic API key actualizada")
@@ -659,7 +1453,14 @@ async def save_settings(
 # ============================================
 
 def clean_nan_values(obj):
-    """Limpia NaN/Infinity de objetos para JSON válido en PostgreSQL"""
+    """
+    Limpia NaN/Infinity de objetos para JSON válido en PostgreSQL.
+    Solo para estructuras chicas (respuesta de la IA); los DataFrames pasan
+    por dataframe_to_records, que hace lo mismo vectorizado.
+    """
+    # Los tipos más comunes salen sin llegar a pd.isna (lento por llamada)
+    if obj is None or isinstance(obj, (str, bool, int)):
+        return obj
     if isinstance(obj, dict):
         return {k: clean_nan_values(v) for k, v in obj.items()}
     elif isinstance(obj, list):
@@ -673,34 +1474,210 @@ def clean_nan_values(obj):
     return obj
 
 
-def extract_text_from_pdf(content: bytes) -> str:
-    """Extrae texto de un PDF usando pdfplumber"""
-    text_content = []
-    with pdfplumber.open(BytesIO(content)) as pdf:
-        for page in pdf.pages:
-            tables = page.extract_tables()
-            if tables:
-                for table in tables:
-                    for row in table:
-                        if row:
-                            text_content.append(" | ".join([str(cell) if cell else "" for cell in row]))
-            else:
-                text = page.extract_text()
-                if text:
-                    text_content.append(text)
-    return "\n".join(text_content)
+def dataframe_to_records(df: pd.DataFrame) -> list:
+    """
+    df.to_dict(orient='records') sin NaN/NaT/Infinity (quedan como None).
+    Misma salida que clean_nan_values(df.to_dict(...)) pero con máscaras
+    vectorizadas en lugar de revisar celda por celda en Python.
+    """
+    clean = df.replace([np.inf, -np.inf], np.nan)
+    return clean.astype(object).where(clean.notna(), None).to_dict(orient='records')
 
 
-async def analyze_fields_with_ai(data_preview: list, columns: list, filename: str) -> dict:
-    """Usa AI para detectar y mapear campos automáticamente"""
+# Metadata del Parquet con las columnas guardadas como celdas JSON
+PARQUET_JSON_COLUMNS_KEY = b"ciclops_json_columns"
+
+
+def _is_mixed_text_column(series: pd.Series) -> bool:
+    """
+    Columna object con texto y no-texto a la vez. En el Estado de Resultados
+    cada columna de tienda trae el nombre en la primera fila y montos abajo;
+    pyarrow no puede guardarla ("Expected bytes, got a 'int' object").
+    """
+    if series.dtype != object:
+        return False
+    kinds = {isinstance(value, str) for value in series.dropna()}
+    return len(kinds) > 1
+
+
+def _encode_json_cells(series: pd.Series) -> list:
+    """Cada celda como JSON (conserva str/int/float por celda); nulos quedan nulos"""
+    option = orjson.OPT_SERIALIZE_NUMPY
+    return [
+        None if pd.isna(value) else orjson.dumps(value, default=str, option=option).decode()
+        for value in series
+    ]
+
+
+def dataframe_to_parquet(df: pd.DataFrame) -> Optional[bytes]:
+    """
+    Serializa un DataFrame a Parquet (zstd). Las columnas con texto y números
+    mezclados se guardan como celdas JSON y se listan en la metadata del
+    archivo para restaurarlas al leer. Retorna None si no se puede (pyarrow no
+    instalado, tipos no soportados); en ese caso los datos se guardan como JSON.
+    """
+    if pa is None:
+        return None
+    try:
+        json_columns = [col for col in df.columns if _is_mixed_text_column(df[col])]
+        if json_columns:
+            df = df.assign(**{col: _encode_json_cells(df[col]) for col in json_columns})
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if json_columns:
+            table = table.replace_schema_metadata({
+                **(table.schema.metadata or {}),
+                PARQUET_JSON_COLUMNS_KEY: orjson.dumps(json_columns)
+            })
+        buffer = BytesIO()
+        pq.write_table(table, buffer, compression='zstd')
+        return buffer.getvalue()
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar como Parquet, se usa JSON: {e}")
+        return None
+
+
+def read_raw_parquet(data: bytes) -> pd.DataFrame:
+    """Inverso de dataframe_to_parquet: decodifica las columnas de celdas JSON"""
+    table = pq.read_table(BytesIO(data))
+    df = table.to_pandas()
+    json_columns = (table.schema.metadata or {}).get(PARQUET_JSON_COLUMNS_KEY)
+    for col in orjson.loads(json_columns) if json_columns else []:
+        df[col] = pd.Series(
+            [orjson.loads(value) if isinstance(value, str) else None for value in df[col]],
+            index=df.index, dtype=object
+        )
+    return df
+
+
+def load_raw_dataframe(raw) -> pd.DataFrame:
+    """DataFrame completo de un documento Excel/CSV (Parquet o JSON legado)"""
+    if raw is None:
+        return pd.DataFrame()
+    if raw.raw_parquet:
+        return read_raw_parquet(raw.raw_parquet)
+    return pd.DataFrame((raw.raw_json or {}).get("data", []))
+
+
+def load_raw_records(raw) -> list:
+    """Filas de un documento Excel/CSV como lista de dicts, sin NaN"""
+    if raw is not None and raw.raw_parquet:
+        return dataframe_to_records(load_raw_dataframe(raw))
+    return (raw.raw_json or {}).get("data", []) if raw is not None else []
+
+
+# PDFs con más páginas que esto se procesan en un proceso aparte
+PDF_PROCESS_POOL_MIN_PAGES = 20
+_pdf_process_pool = None
+
+
+def _get_pdf_process_pool() -> ProcessPoolExecutor:
+    """Pool de procesos para PDFs grandes (se crea la primera vez que se usa)"""
+    global _pdf_process_pool
+    if _pdf_process_pool is None:
+        # Un worker nuevo por tarea: la memoria del parseo se libera al terminar.
+        # spawn explícito (max_tasks_per_child no admite fork): el proceso solo
+        # importa app.pdf_worker, no este módulo con su engine y migraciones
+        _pdf_process_pool = ProcessPoolExecutor(
+            max_workers=2,
+            max_tasks_per_child=1,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pdf_process_pool
+
+
+async def extract_text_from_pdf(content: bytes) -> str:
+    """
+    Extrae texto de un PDF (PyMuPDF; sin él PDFium, y pdfplumber como último
+    recurso) fuera del event loop: los PDFs grandes en el pool de procesos,
+    el resto en un hilo.
+    """
+    if await asyncio.to_thread(pdf_page_count, content) > PDF_PROCESS_POOL_MIN_PAGES:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_pdf_process_pool(), extract_pdf_pages, content)
+    return await asyncio.to_thread(extract_pdf_pages, content)
+
+
+# Cache de mapeos de la IA por esquema de columnas (plantillas que se suben cada mes)
+AI_MAPPING_CACHE_SIZE = 512
+_ai_mapping_cache: "OrderedDict[str, str]" = OrderedDict()
+
+
+def _ai_cache_key(data_preview: list, columns: list, sheets: list = None) -> str:
+    """Huella del esquema: columnas ordenadas, columnas por hoja y forma de la primera fila"""
+    first_row = data_preview[0] if data_preview else {}
+    schema = {
+        "columns": sorted(str(col) for col in columns),
+        "sheets": [[sheet["name"], sorted(str(col) for col in sheet["columns"])] for sheet in sheets or []],
+        "first_row": sorted(str(k) for k, v in first_row.items() if v is not None),
+    }
+    return hashlib.sha1(orjson.dumps(schema)).hexdigest()
+
+
+def _remember_ai_mapping(cache_key: str, result: str):
+    _ai_mapping_cache[cache_key] = result
+    _ai_mapping_cache.move_to_end(cache_key)
+    if len(_ai_mapping_cache) > AI_MAPPING_CACHE_SIZE:
+        _ai_mapping_cache.popitem(last=False)
+
+
+def load_ai_mapping(cache_key: str) -> Optional[str]:
+    """Mapeo guardado en la base para este esquema (None si no hay o falla la consulta)"""
+    db = SessionLocal()
+    try:
+        return db.scalar(
+            select(models.AIMappingCache.result).where(models.AIMappingCache.schema_hash == cache_key)
+        )
+    except Exception as e:
+        print(f"⚠️ No se pudo leer ai_mapping_cache: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def store_ai_mapping(cache_key: str, result: str):
+    """Persiste el mapeo para que sobreviva reinicios y lo compartan todos los workers"""
+    db = SessionLocal()
+    try:
+        db.merge(models.AIMappingCache(schema_hash=cache_key, result=result))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"⚠️ No se pudo guardar ai_mapping_cache: {e}")
+    finally:
+        db.close()
+
+
+async def analyze_fields_with_ai(data_preview: list, columns: list, filename: str, sheets: list = None) -> dict:
+    """
+    Usa AI para detectar y mapear campos automáticamente.
+    sheets: [{"name", "columns", "preview"}] por hoja; todas las hojas se
+    analizan en la MISMA llamada en lugar de una llamada por hoja.
+    """
     if not openai_client:
         return {"detected_fields": columns, "mapping": {}, "data_type": "unknown"}
 
+    cache_key = _ai_cache_key(data_preview, columns, sheets)
+    cached = _ai_mapping_cache.get(cache_key)
+    if cached is None:
+        # Otro worker o un proceso anterior ya pudo haber mapeado esta plantilla
+        cached = await asyncio.to_thread(load_ai_mapping, cache_key)
+    if cached is not None:
+        _remember_ai_mapping(cache_key, cached)
+        return orjson.loads(cached)
+
     try:
         # Crear resumen de datos para AI
-        sample_data = json.dumps(data_preview[:5], ensure_ascii=False, indent=2)
+        sample_data = dumps_json(data_preview[:5], indent=True)
+
+        sheets_section = ""
+        if sheets and len(sheets) > 1:
+            sheets_section = "\n\nHojas del archivo:\n" + "\n".join(
+                f"- {sheet['name']}: columnas {sheet['columns']}\n"
+                f"  Muestra: {dumps_json(sheet['preview'][:3])}"
+                for sheet in sheets
+            )
 
-        response = openai_client.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {
@@ -719,8 +1696,12 @@ Responde SOLO con JSON válido con esta estructura:
         }
     },
     "summary": "descripción de qué contiene este archivo",
-    "recommended_category": "categoria sugerida para el vault"
-}"""
+    "recommended_category": "categoria sugerida para el vault",
+    "sheets": {
+        "nombre_hoja": {"data_type": "tipo de la hoja", "summary": "qué contiene la hoja"}
+    }
+}
+Incluye "sheets" solo si el archivo trae varias hojas."""
                 },
                 {
                     "role": "user",
@@ -728,13 +1709,14 @@ Responde SOLO con JSON válido con esta estructura:
 Columnas detectadas: {columns}
 
 Muestra de datos:
-{sample_data}
+{sample_data}{sheets_section}
 
 Analiza y mapea estos campos."""
                 }
             ],
+            response_format={"type": "json_object"},
             temperature=0.1,
-            max_tokens=1000
+            max_tokens=1500
         )
 
         result = response.choices[0].message.content
@@ -745,7 +1727,10 @@ Analiza y mapea estos campos."""
                 result = result[4:]
         result = result.strip()
 
-        return json.loads(result)
+        mapping = orjson.loads(result)
+        _remember_ai_mapping(cache_key, result)
+        await asyncio.to_thread(store_ai_mapping, cache_key, result)
+        return mapping
     except Exception as e:
         print(f"Error en análisis AI: {e}")
         return {
@@ -806,14 +1791,14 @@ class SmartDocumentProcessor:
         3. Mapea conceptos a categorías estándar
         4. Guarda en monthly_summaries
         """
-        doc = db.query(models.Document).filter(models.Document.id == doc_id).first()
+        doc = db.scalars(select(models.Document).where(models.Document.id == doc_id)).first()
         if not doc:
             return {"success": False, "error": "Documento no encontrado"}
 
         # Obtener datos raw del documento
-        raw_data = db.query(models.RawDocumentData).filter(
+        raw_data = db.scalars(select(models.RawDocumentData).where(
             models.RawDocumentData.document_id == doc_id
-        ).first()
+        )).first()
 
         doc_data = db.query(models.DocumentData).filter(
             models.DocumentData.document_id == doc_id
@@ -854,7 +1839,7 @@ class SmartDocumentProcessor:
         """
         # Preparar muestra del contenido
         if isinstance(content, list):
-            sample = json.dumps(content[:20], ensure_ascii=False, default=str)[:4000]
+            sample = dumps_json(content[:20])[:4000]
         elif isinstance(content, str):
             sample = content[:4000]
         else:
@@ -905,14 +1890,14 @@ Responde SOLO con JSON válido:
         try:
             # Intentar con Claude primero (mejor para análisis complejo)
             if self.anthropic_client:
-                response = self.anthropic_client.messages.create(
+                response = await self.anthropic_client.messages.create(
                     model="claude-sonnet-4-20250514",
                     max_tokens=2000,
                     messages=[{"role": "user", "content": prompt}]
                 )
                 result_text = response.content[0].text
             elif self.ai_client:
-                response = self.ai_client.chat.completions.create(
+                response = await self.ai_client.chat.completions.create(
                     model="gpt-4o",
                     messages=[
                         {"role": "system", "content": "Eres un experto en análisis de documentos financieros de restaurantes."},
@@ -932,7 +1917,7 @@ Responde SOLO con JSON válido:
                     result_text = result_text[4:]
             result_text = result_text.strip()
 
-            return json.loads(result_text)
+            return orjson.loads(result_text)
 
         except Exception as e:
             print(f"Error en detección de metadatos: {e}")
@@ -991,7 +1976,7 @@ Responde SOLO con JSON válido:
 
         # Preparar contenido para AI
         if isinstance(content, list):
-            content_str = json.dumps(content[:100], ensure_ascii=False, default=str)
+            content_str = dumps_json(content[:100])
         else:
             content_str = str(content)[:8000]
 
@@ -1042,14 +2027,14 @@ Responde SOLO con JSON válido:
 
         try:
             if self.anthropic_client:
-                response = self.anthropic_client.messages.create(
+                response = await self.anthropic_client.messages.create(
                     model="claude-sonnet-4-20250514",
                     max_tokens=4000,
                     messages=[{"role": "user", "content": prompt}]
                 )
                 result_text = response.content[0].text
             elif self.ai_client:
-                response = self.ai_client.chat.completions.create(
+                response = await self.ai_client.chat.completions.create(
                     model="gpt-4o",
                     messages=[
                         {"role": "system", "content": "Eres un experto en extracción de datos financieros. Responde solo con JSON válido."},
@@ -1069,7 +2054,7 @@ Responde SOLO con JSON válido:
                     result_text = result_text[4:]
             result_text = result_text.strip()
 
-            return json.loads(result_text)
+            return orjson.loads(result_text)
 
         except Exception as e:
             print(f"Error en extracción estructurada: {e}")
@@ -1094,8 +2079,7 @@ Responde SOLO con JSON válido:
             "RESUMEN", "CONSOLIDADO", "_hoja_origen", "nan", "None"
         ]
 
-        saved_count = 0
-        updated_count = 0
+        rows = []
         errors = []
 
         for store_name, store_data in stores_data.items():
@@ -1121,56 +2105,32 @@ Responde SOLO con JSON válido:
                 # Calcular márgenes
                 gross_margin = ((ingresos - costo_ventas) / ingresos * 100) if ingresos > 0 else 0
                 net_margin = (utilidad / ingresos * 100) if ingresos > 0 else 0
-                labor_ratio = (nomina / ingresos * 100) if ingresos > 0 else 0
-                rent_ratio = (renta / ingresos * 100) if ingresos > 0 else 0
 
-                # Buscar registro existente
-                existing = db.query(models.MonthlySummary).filter(
-                    models.MonthlySummary.store_name == store_name,
-                    models.MonthlySummary.period == period_label
-                ).first()
-
-                if existing:
-                    # Actualizar existente
-                    existing.total_sales = ingresos
-                    existing.cost_of_sales = costo_ventas
-                    existing.labor_cost = nomina
-                    existing.rent = renta
-                    existing.utilities = servicios
-                    existing.operating_expenses = total_gastos
-                    existing.net_profit = utilidad
-                    existing.gross_margin = gross_margin
-                    existing.net_margin = net_margin
-                    existing.labor_ratio = labor_ratio
-                    existing.rent_ratio = rent_ratio
-                    existing.document_id = doc_id
-                    updated_count += 1
-                else:
-                    # Crear nuevo
-                    summary = models.MonthlySummary(
-                        store_name=store_name,
-                        period=period_label,
-                        total_sales=ingresos,
-                        cost_of_sales=costo_ventas,
-                        labor_cost=nomina,
-                        rent=renta,
-                        utilities=servicios,
-                        operating_expenses=total_gastos,
-                        net_profit=utilidad,
-                        gross_margin=gross_margin,
-                        net_margin=net_margin,
-                        labor_ratio=labor_ratio,
-                        rent_ratio=rent_ratio,
-                        document_id=doc_id
-                    )
-                    db.add(summary)
-                    saved_count += 1
+                rows.append({
+                    "store_id": store_id_from_name(store_name),
+                    "store_name": store_name,
+                    "period": period_label,
+                    "total_sales": ingresos,
+                    "cost_of_sales": costo_ventas,
+                    "gross_profit": ingresos - costo_ventas,
+                    "labor_cost": nomina,
+                    "rent": renta,
+                    "utilities": servicios,
+                    "operating_expenses": total_gastos,
+                    "net_profit": utilidad,
+                    "gross_margin": gross_margin,
+                    "net_margin": net_margin,
+                    "document_id": doc_id
+                })
 
             except Exception as e:
                 errors.append(f"{store_name}: {str(e)}")
                 continue
 
-        db.commit()
+        # UPSERT por (store_id, period) en un solo statement
+        upsert_result = upsert_monthly_summaries(rows, db)
+        saved_count = upsert_result["created"]
+        updated_count = upsert_result["updated"]
 
         return {
             "period": period_label,
@@ -1206,51 +2166,357 @@ async def process_document_smart(doc_id: int, db: Session) -> dict:
     return await smart_processor.process_document(doc_id, db)
 
 
-def detect_period_from_filename(filename: str) -> str:
-    """Detecta el periodo/fecha del nombre del archivo"""
-    import re
+# Patrones de detect_period_from_filename (compilados una sola vez; IGNORECASE
+# evita crear copias upper()/lower() del nombre)
+_PERIOD_RE = re.compile(r'P(\d{1,2})', re.IGNORECASE)
+_WEEKS_RE = re.compile(r'S(\d+)\s*A\s*S(\d+)', re.IGNORECASE)
+_YEAR_RE = re.compile(r'20\d{2}')
+_MONTHS_RE = re.compile(
+    r'enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|octubre|noviembre|diciembre',
+    re.IGNORECASE
+)
+
+# Mapeo de periodos a meses
+PERIOD_MONTHS = {
+    'P1': 'Enero', 'P2': 'Febrero', 'P3': 'Marzo', 'P4': 'Abril',
+    'P5': 'Mayo', 'P6': 'Junio', 'P7': 'Julio', 'P8': 'Agosto',
+    'P9': 'Septiembre', 'P10': 'Octubre', 'P11': 'Noviembre', 'P12': 'Diciembre'
+}
 
-    # Mapeo de periodos a meses
-    period_months = {
-        'P1': 'Enero', 'P2': 'Febrero', 'P3': 'Marzo', 'P4': 'Abril',
-        'P5': 'Mayo', 'P6': 'Junio', 'P7': 'Julio', 'P8': 'Agosto',
-        'P9': 'Septiembre', 'P10': 'Octubre', 'P11': 'Noviembre', 'P12': 'Diciembre'
-    }
 
+def detect_period_from_filename(filename: str) -> str:
+    """Detecta el periodo/fecha del nombre del archivo"""
     # Buscar patrón P## (periodo)
-    period_match = re.search(r'P(\d{1,2})', filename.upper())
+    period_match = _PERIOD_RE.search(filename)
     if period_match:
         period_num = f"P{period_match.group(1)}"
-        month = period_months.get(period_num, f"Periodo {period_match.group(1)}")
+        month = PERIOD_MONTHS.get(period_num, f"Periodo {period_match.group(1)}")
 
         # Buscar semanas S## A S##
-        weeks_match = re.search(r'S(\d+)\s*A\s*S(\d+)', filename.upper())
+        weeks_match = _WEEKS_RE.search(filename)
         if weeks_match:
             return f"{month} (S{weeks_match.group(1)}-S{weeks_match.group(2)})"
         return month
 
-    # Buscar meses en español
-    months_es = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio',
-                 'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
-    for month in months_es:
-        if month in filename.lower():
-            return month.capitalize()
+    # Buscar meses en español (una sola búsqueda en lugar de un loop por mes)
+    month_match = _MONTHS_RE.search(filename)
+    if month_match:
+        return month_match.group(0).capitalize()
 
     # Buscar año
-    year_match = re.search(r'20\d{2}', filename)
+    year_match = _YEAR_RE.search(filename)
     if year_match:
         return year_match.group(0)
 
     # Default: fecha actual
-    from datetime import datetime
     return datetime.now().strftime('%B %Y').capitalize()
 
 
+def _excel_header(row: tuple) -> list:
+    """
+    Nombres de columna igual que pandas: celdas vacías -> 'Unnamed: i'
+    y duplicados -> 'X.1', 'X.2' (el resto del código depende de esto).
+    """
+    original = [f"Unnamed: {i}" if value is None else str(value) for i, value in enumerate(row)]
+    columns = []
+    counts = defaultdict(int)
+    for name in original:
+        base = name
+        count = counts[name]
+        while count > 0:
+            counts[base] = count + 1
+            name = f"{base}.{count}"
+            # No chocar con un encabezado que ya se llama así
+            count = count + 1 if name in original else counts[name]
+        counts[name] = count + 1
+        columns.append(name)
+    return columns
+
+
+def _excel_cell(value):
+    """Igual que pandas: números enteros guardados como float -> int"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def iter_xlsx_sheets(source):
+    """
+    Recorre las hojas de un .xlsx en modo read_only (streaming de filas,
+    sin cargar estilos ni el grafo de celdas). Genera (nombre, DataFrame).
+    source: archivo binario (no se carga completo en memoria).
+    """
+    wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            rows = []
+            for row in ws.iter_rows(values_only=True):
+                # Quitar celdas vacías al final (read_only reporta dimensiones de más)
+                row = list(row)
+                while row and row[-1] is None:
+                    row.pop()
+                rows.append([_excel_cell(v) for v in row])
+
+            # Quitar filas vacías al final antes de tomar el ancho
+            while rows and not rows[-1]:
+                rows.pop()
+            if not rows:
+                yield ws.title, pd.DataFrame()
+                continue
+
+            width = max(len(r) for r in rows)
+            header = rows[0] + [None] * (width - len(rows[0]))
+            # Filas vacías ya quedaron como [] al recortar: se descartan aquí
+            # en lugar de un dropna(how='all') sobre todo el DataFrame
+            data = [r + [None] * (width - len(r)) for r in rows[1:] if r]
+            yield ws.title, pd.DataFrame(data, columns=_excel_header(header))
+    finally:
+        wb.close()
+
+
+def _read_calamine_sheet(content: bytes, sheet_name: str) -> pd.DataFrame:
+    """Parsea una hoja con su propio BytesIO (un lector por hilo)"""
+    return pd.read_excel(BytesIO(content), sheet_name=sheet_name, engine="calamine").dropna(how='all')
+
+
+def read_calamine_sheets(source) -> list:
+    """
+    Lee todas las hojas con calamine. Las hojas son independientes, así que
+    con varias se parsean en paralelo (calamine suelta el GIL mientras lee).
+    Retorna [(nombre, DataFrame)] en el orden del libro.
+    """
+    excel_file = pd.ExcelFile(source, engine="calamine")
+    sheet_names = excel_file.sheet_names
+    if len(sheet_names) <= 1:
+        return [(name, excel_file.parse(name).dropna(how='all')) for name in sheet_names]
+
+    source.seek(0)
+    content = source.read()
+    workers = min(len(sheet_names), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_read_calamine_sheet, content, name) for name in sheet_names]
+        return [(name, future.result()) for name, future in zip(sheet_names, futures)]
+
+
+def read_tabular_file(source, filename: str, nrows: Optional[int] = None) -> tuple:
+    """
+    Lee un Excel (todas las hojas) o CSV desde un archivo binario.
+    Con nrows solo se leen las primeras filas de cada hoja (preview).
+    Retorna (lista de DataFrames no vacíos, info de hojas).
+    """
+    all_dfs = []
+    sheets_info = []
+
+    if filename.endswith('.csv'):
+        if nrows is not None:
+            # El engine de pyarrow no soporta nrows; para unas filas no hace falta
+            df = pd.read_csv(source, nrows=nrows)
+        else:
+            try:
+                # Parser multihilo de Arrow; mucho más rápido en CSVs grandes
+                df = pd.read_csv(source, engine='pyarrow')
+            except Exception:
+                # Sin pyarrow o CSV irregular (filas con distinto número de campos)
+                source.seek(0)
+                df = pd.read_csv(source)
+        df.columns = [str(col).strip() for col in df.columns]
+        df = df.dropna(how='all')
+        if not df.empty:
+            all_dfs.append(df)
+            sheets_info.append({"name": "Datos", "rows": len(df)})
+    else:
+        # Excel: leer TODAS las hojas y combinarlas
+        if nrows is not None:
+            # Preview: el lector deja de recorrer cada hoja al llegar a nrows
+            sheets = (
+                (name, df.dropna(how='all'))
+                for name, df in pd.read_excel(
+                    source, sheet_name=None, nrows=nrows,
+                    engine="calamine" if python_calamine is not None else None
+                ).items()
+            )
+        elif python_calamine is not None:
+            # calamine lee .xlsx y .xls varias veces más rápido que openpyxl/xlrd
+            sheets = read_calamine_sheets(source)
+        elif filename.endswith('.xls'):
+            # openpyxl no lee .xls (formato binario viejo). sheet_name=None lee
+            # todas las hojas en una llamada sobre el mismo libro abierto
+            sheets = (
+                (name, df.dropna(how='all'))
+                for name, df in pd.read_excel(source, sheet_name=None).items()
+            )
+        else:
+            # iter_xlsx_sheets ya omite las filas vacías
+            sheets = iter_xlsx_sheets(source)
+
+        for sheet_name, df in sheets:
+            df.columns = [str(col).strip() for col in df.columns]
+            if not df.empty and len(df.columns) > 0:
+                # _hoja_origen se agrega al combinar (combine_sheet_frames)
+                all_dfs.append(df)
+                sheets_info.append({"name": sheet_name, "rows": len(df)})
+
+    return all_dfs, sheets_info
+
+
+def combine_sheet_frames(all_dfs: list, sheets_info: list, with_origin: bool) -> pd.DataFrame:
+    """
+    Concatena las hojas en un DataFrame. Con with_origin (Excel) agrega
+    _hoja_origen como un solo arreglo armado con np.repeat, en lugar de
+    asignar una columna de texto a cada hoja antes del concat.
+    """
+    combined = pd.concat(all_dfs, ignore_index=True, sort=False)
+    if with_origin:
+        combined['_hoja_origen'] = np.repeat(
+            np.array([info["name"] for info in sheets_info], dtype=object),
+            [len(df) for df in all_dfs]
+        )
+    return combined
+
+
+async def analyze_tabular_upload(
+    preview_records: list, columns: list, filename: str,
+    sheets_preview: list, sheets_info: list, total_rows: int, skip_ai: bool
+) -> dict:
+    """Análisis AI de campos de un Excel/CSV (o análisis mínimo si skip_ai)"""
+    if skip_ai:
+        return {
+            "data_type": "imported",
+            "detected_fields": {col: {"mapped_to": col, "type": "text"} for col in columns},
+            "summary": f"Importado - {total_rows} filas de {len(sheets_info)} hoja(s)",
+            "recommended_category": "general",
+            "sheets_combined": sheets_info
+        }
+
+    # Sin clean_nan_values: el resultado sale de orjson.loads (que rechaza
+    # NaN/Infinity) o de dicts con nombres de columna ya convertidos a str
+    ai_analysis = await analyze_fields_with_ai(preview_records, columns, filename, sheets=sheets_preview)
+    ai_analysis["sheets_combined"] = sheets_info
+    return ai_analysis
+
+
+async def save_raw_tabular_data(
+    db: Session, doc_id: int, combined_df: pd.DataFrame,
+    ai_analysis: dict, sheets_info: list, preview_records: list
+):
+    """
+    Agrega los datos raw a la sesión: Parquet para el frame completo, JSON
+    solo para metadata. El commit lo hace quien llama.
+    """
+    raw_json = {
+        "ai_analysis": ai_analysis,
+        "sheets_combined": sheets_info
+    }
+    raw_parquet = await asyncio.to_thread(dataframe_to_parquet, combined_df)
+    if raw_parquet is None:
+        raw_json["data"] = await asyncio.to_thread(dataframe_to_records, combined_df)
+    raw_data = models.RawDocumentData(
+        document_id=doc_id,
+        raw_json=raw_json,
+        raw_parquet=raw_parquet,
+        preview_data=preview_records
+    )
+    db.add(raw_data)
+
+
+def parse_tabular_upload(source, filename: str) -> tuple:
+    """
+    Parseo completo de un Excel/CSV subido.
+    Retorna (combined_df, preview_records, columns, sheets_preview, sheets_info);
+    combined_df es None si no hay datos.
+    """
+    all_dfs, sheets_info = read_tabular_file(source, filename)
+    if not all_dfs:
+        return None, [], [], [], sheets_info
+
+    combined_df = combine_sheet_frames(all_dfs, sheets_info, not filename.endswith('.csv'))
+    # Solo las primeras filas se convierten a dict para preview y AI
+    preview_records = dataframe_to_records(combined_df.head(20))
+    sheets_preview = [
+        {
+            "name": info["name"],
+            "columns": list(df.columns),
+            "preview": dataframe_to_records(df.head(3))
+        }
+        for df, info in zip(all_dfs, sheets_info)
+    ]
+    return combined_df, preview_records, list(combined_df.columns), sheets_preview, sheets_info
+
+
+async def finalize_upload(doc_id: int, upload_path: str, filename: str, skip_ai: bool):
+    """
+    Tarea en segundo plano de /upload?background=true: parseo completo del
+    archivo (copiado a upload_path), análisis AI y guardado de datos raw.
+    Deja el documento en pending_confirmation (o error) y borra el temporal.
+    Usa su propia sesión: la del request ya se cerró.
+    """
+    db = SessionLocal()
+    try:
+        with open(upload_path, "rb") as source:
+            combined_df, preview_records, columns, sheets_preview, sheets_info = await asyncio.to_thread(
+                parse_tabular_upload, source, filename.lower()
+            )
+        if combined_df is None:
+            raise ValueError("No se encontraron datos válidos en el archivo")
+
+        ai_analysis = await analyze_tabular_upload(
+            preview_records, columns, filename, sheets_preview, sheets_info, len(combined_df), skip_ai
+        )
+        await save_raw_tabular_data(db, doc_id, combined_df, ai_analysis, sheets_info, preview_records)
+
+        doc = db.get(models.Document, doc_id)
+        if doc:
+            doc.rows_count = len(combined_df)
+            doc.columns = columns
+            doc.status = "pending_confirmation"
+        await asyncio.to_thread(db.commit)
+        print(f"✅ Upload {doc_id} procesado en segundo plano")
+    except Exception as e:
+        print(f"❌ Error procesando upload {doc_id} en segundo plano: {e}")
+        traceback.print_exc()
+        db.rollback()
+        doc = db.get(models.Document, doc_id)
+        if doc:
+            doc.status = "error"
+            db.commit()
+    finally:
+        db.close()
+        os.unlink(upload_path)
+
+
+# Filas por hoja que se leen en el request con background=true (solo preview)
+UPLOAD_PREVIEW_ROWS = 100
+
+
+def save_upload_copy(file: UploadFile, suffix: str) -> str:
+    """Copia el archivo subido a un temporal propio (el de UploadFile se cierra con el request)"""
+    file.file.seek(0)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        shutil.copyfileobj(file.file, tmp, length=1024 * 1024)
+    return tmp.name
+
+
+# Tamaño máximo de archivo subido (MB)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "50")) * 1024 * 1024
+
+
+def upload_size(file: UploadFile) -> int:
+    """Tamaño del archivo subido sin leerlo (Starlette ya lo guardó en un SpooledTemporaryFile)"""
+    if file.size is not None:
+        return file.size
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+    return size
+
+
 @app.post("/upload")
 async def upload_file(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
     skip_ai: bool = Query(default=False, description="Skip AI analysis for faster uploads"),
+    background: bool = Query(default=False, description="Responder al terminar el parseo; AI y guardado en segundo plano"),
     current_user: dict = Depends(get_current_user)
 ):
     """
@@ -1267,11 +2533,21 @@ async def upload_file(
                 detail="Solo se permiten archivos Excel, CSV o PDF"
             )
 
-        content = await file.read()
+        # Rechazar antes de parsear o cargar nada en memoria
+        if upload_size(file) > MAX_UPLOAD_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"El archivo excede el máximo de {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"
+            )
+
         is_pdf = filename.endswith('.pdf')
 
         if is_pdf:
-            pdf_text = extract_text_from_pdf(content)
+            # PyMuPDF y el pool de procesos necesitan los bytes del PDF
+            # (acotado por MAX_UPLOAD_BYTES)
+            content = await file.read()
+            # Parseo CPU-bound fuera del event loop
+            pdf_text = await extract_text_from_pdf(content)
             lines = [line.strip() for line in pdf_text.split('\n') if line.strip()]
 
             # Crear documento en DB
@@ -1284,24 +2560,28 @@ async def upload_file(
                 status="pending_confirmation"
             )
             db.add(doc)
-            db.commit()
-            db.refresh(doc)
+            db.flush()  # Obtener doc.id sin cerrar la transacción
+            doc_id = doc.id
 
-            # Guardar datos raw
+            # Guardar datos raw (mismo commit que el documento)
             raw_data = models.RawDocumentData(
-                document_id=doc.id,
+                document_id=doc_id,
                 raw_text=pdf_text,
                 preview_data=lines[:20]
             )
             db.add(raw_data)
-            db.commit()
+            # El INSERT lleva todo el texto del PDF: el commit va en un hilo
+            # para no bloquear el event loop mientras escribe
+            await asyncio.to_thread(db.commit)
 
+            # Respuesta con valores locales: tras el commit leer doc.* dispara
+            # un SELECT para recargar el objeto expirado
             return {
                 "success": True,
                 "message": f"Archivo '{file.filename}' procesado - pendiente confirmación",
                 "document": {
-                    "id": doc.id,
-                    "filename": doc.filename,
+                    "id": doc_id,
+                    "filename": file.filename,
                     "type": "pdf",
                     "rows": len(lines),
                     "columns": ["contenido"],
@@ -1312,97 +2592,108 @@ async def upload_file(
 
         else:
             # Excel o CSV - Combinar todas las hojas en UN solo documento
-            all_dfs = []
-            sheets_info = []
-
-            if filename.endswith('.csv'):
-                df = pd.read_csv(BytesIO(content))
-                df.columns = [str(col).strip() for col in df.columns]
-                df = df.dropna(how='all')
-                if not df.empty:
-                    all_dfs.append(df)
-                    sheets_info.append({"name": "Datos", "rows": len(df)})
-            else:
-                # Excel: leer TODAS las hojas y combinarlas
-                excel_file = pd.ExcelFile(BytesIO(content))
-                for sheet_name in excel_file.sheet_names:
-                    df = pd.read_excel(excel_file, sheet_name=sheet_name)
-                    df.columns = [str(col).strip() for col in df.columns]
-                    df = df.dropna(how='all')
-                    if not df.empty and len(df.columns) > 0:
-                        # Agregar columna para identificar la hoja de origen
-                        df['_hoja_origen'] = sheet_name
-                        all_dfs.append(df)
-                        sheets_info.append({"name": sheet_name, "rows": len(df)})
-
-            if not all_dfs:
-                raise HTTPException(status_code=400, detail="No se encontraron datos válidos en el archivo")
+            file_type = "excel" if not filename.endswith('.csv') else "csv"
+
+            if background:
+                # Solo las primeras filas de cada hoja para responder rápido; el
+                # parseo completo, la AI y el guardado van en segundo plano
+                file.file.seek(0)
+                preview_dfs, preview_sheets = await asyncio.to_thread(
+                    read_tabular_file, file.file, filename, UPLOAD_PREVIEW_ROWS
+                )
+                if not preview_dfs:
+                    raise HTTPException(status_code=400, detail="No se encontraron datos válidos en el archivo")
+                preview_df = combine_sheet_frames(preview_dfs, preview_sheets, file_type == "excel")
+                columns = list(preview_df.columns)
+                upload_path = await asyncio.to_thread(
+                    save_upload_copy, file, os.path.splitext(filename)[1]
+                )
 
-            # Combinar todos los DataFrames
-            combined_df = pd.concat(all_dfs, ignore_index=True, sort=False)
-
-            # Convertir a dict y limpiar NaN
-            data = combined_df.to_dict(orient='records')
-            data = clean_nan_values(data)
-            columns = list(combined_df.columns)
-
-            # Analizar con AI
-            if skip_ai:
-                ai_analysis = {
-                    "data_type": "imported",
-                    "detected_fields": {col: {"mapped_to": col, "type": "text"} for col in columns},
-                    "summary": f"Importado - {len(combined_df)} filas de {len(sheets_info)} hoja(s)",
-                    "recommended_category": "general",
-                    "sheets_combined": sheets_info
+                # La tarea usa otra sesión: el documento debe existir ya
+                doc = models.Document(
+                    filename=file.filename,
+                    file_type=file_type,
+                    rows_count=0,
+                    columns=columns,
+                    period=detected_period,
+                    status="processing"
+                )
+                db.add(doc)
+                db.flush()
+                doc_id = doc.id
+                db.commit()
+                # El frontend consulta /documents/{id}/status hasta que pase a
+                # pending_confirmation (ahí ya trae el total de filas)
+                background_tasks.add_task(finalize_upload, doc_id, upload_path, file.filename, skip_ai)
+                return {
+                    "success": True,
+                    "message": f"Archivo '{file.filename}' recibido - {len(preview_sheets)} hoja(s); procesando en segundo plano",
+                    "sheets_count": 1,
+                    "documents": [{
+                        "id": doc_id,
+                        "filename": file.filename,
+                        "type": file_type,
+                        "rows": None,
+                        "columns": columns,
+                        "preview": dataframe_to_records(preview_df.head(5)),
+                        "ai_analysis": None,
+                        "sheets_combined": [{"name": info["name"]} for info in preview_sheets],
+                        "status": "processing"
+                    }]
                 }
-            else:
-                ai_analysis = await analyze_fields_with_ai(data, columns, file.filename)
-                ai_analysis = clean_nan_values(ai_analysis)
-                ai_analysis["sheets_combined"] = sheets_info
+
+            # Parseo CPU-bound fuera del event loop
+            # Se lee directo del SpooledTemporaryFile de UploadFile (en disco si
+            # es grande) en lugar de copiar todo el archivo a un bytes en memoria
+            file.file.seek(0)
+            combined_df, preview_records, columns, sheets_preview, sheets_info = await asyncio.to_thread(
+                parse_tabular_upload, file.file, filename
+            )
+            if combined_df is None:
+                raise HTTPException(status_code=400, detail="No se encontraron datos válidos en el archivo")
 
             # Crear UN solo documento
             doc = models.Document(
                 filename=file.filename,
-                file_type="excel" if not filename.endswith('.csv') else "csv",
+                file_type=file_type,
                 rows_count=len(combined_df),
                 columns=columns,
                 period=detected_period,
                 status="pending_confirmation"
             )
-            db.add(doc)
-            db.commit()
-            db.refresh(doc)
 
-            # Guardar datos raw
-            raw_data = models.RawDocumentData(
-                document_id=doc.id,
-                raw_json={
-                    "data": data,
-                    "ai_analysis": ai_analysis,
-                    "sheets_combined": sheets_info
-                },
-                preview_data=data[:20]
+            # La llamada a la AI va antes de insertar para no tener la
+            # transacción abierta durante el round-trip
+            ai_analysis = await analyze_tabular_upload(
+                preview_records, columns, file.filename, sheets_preview, sheets_info, len(combined_df), skip_ai
             )
-            db.add(raw_data)
-            db.commit()
+            db.add(doc)
+            db.flush()  # Obtener doc.id sin cerrar la transacción
+            doc_id = doc.id
+            await save_raw_tabular_data(db, doc_id, combined_df, ai_analysis, sheets_info, preview_records)
+            # Documento + datos raw en un solo commit; el INSERT del Parquet
+            # completo va en un hilo para no bloquear el event loop
+            await asyncio.to_thread(db.commit)
 
             return {
                 "success": True,
                 "message": f"Archivo '{file.filename}' procesado - {len(sheets_info)} hoja(s) combinadas, {len(combined_df)} filas totales",
                 "sheets_count": 1,
                 "documents": [{
-                    "id": doc.id,
-                    "filename": doc.filename,
-                    "type": doc.file_type,
+                    "id": doc_id,
+                    "filename": file.filename,
+                    "type": file_type,
                     "rows": len(combined_df),
                     "columns": columns,
-                    "preview": data[:5],
+                    "preview": preview_records[:5],
                     "ai_analysis": ai_analysis,
                     "sheets_combined": sheets_info,
                     "status": "pending_confirmation"
                 }]
             }
 
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
@@ -1412,30 +2703,140 @@ async def upload_file(
 # EXTRACCIÓN DE DATOS FINANCIEROS A SUMMARIES
 # ============================================
 
+def store_id_from_name(store_name: str) -> str:
+    """Genera el store_id normalizado a partir del nombre de la tienda"""
+    return store_name.strip().replace(" ", "_").lower()
+
+
+def upsert_monthly_summaries(rows: list, db: Session) -> dict:
+    """
+    Guarda resúmenes en monthly_summaries con un solo UPSERT por (store_id, period).
+    Cada row es un dict con las columnas de MonthlySummary.
+    Retorna {"created": int, "updated": int}.
+    """
+    if not rows:
+        return {"created": 0, "updated": 0}
+
+    # ON CONFLICT no permite la misma llave dos veces en un statement
+    rows = list({(r["store_id"], r["period"]): r for r in rows}.values())
+    keys = {(r["store_id"], r["period"]) for r in rows}
+
+    # Una sola lectura indexada para saber cuáles ya existen (solo para reportar)
+    existing = db.query(
+        models.MonthlySummary.store_id,
+        models.MonthlySummary.period
+    ).filter(
+        models.MonthlySummary.period.in_({k[1] for k in keys}),
+        models.MonthlySummary.store_id.in_({k[0] for k in keys})
+    ).all()
+    existing_keys = {(e.store_id, e.period) for e in existing} & keys
+
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+
+    stmt = dialect_insert(models.MonthlySummary).values(rows)
+    update_cols = {
+        col: stmt.excluded[col] for col in rows[0].keys()
+        if col not in ("store_id", "period")
+    }
+    update_cols["updated_at"] = func.now()
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["store_id", "period"],
+        set_=update_cols
+    )
+    db.execute(stmt)
+    update_period_deltas(db, {k[0] for k in keys})
+    db.commit()
+
+    return {"created": len(keys) - len(existing_keys), "updated": len(existing_keys)}
+
+
+def period_order(column, descending: bool = False) -> list:
+    """
+    Orden cronológico de etiquetas "2025-P9" / "2025-P10": año, luego número
+    de periodo sin ceros a la izquierda, comparando primero su largo (P9 antes
+    que P10; como texto P10 queda antes que P9). Solo substr/ltrim/length:
+    igual en Postgres y SQLite, y una etiqueta fuera de formato no rompe la query.
+    """
+    number = func.ltrim(func.substr(column, 7), "0")
+    keys = [func.substr(column, 1, 5), func.length(number), number]
+    return [desc(key) for key in keys] if descending else keys
+
+
+def period_sort_key(period: Optional[str]) -> tuple:
+    """La misma clave que period_order, para ordenar en Python"""
+    period = period or ""
+    number = period[6:].lstrip("0")
+    return (period[:5], len(number), number)
+
+
+# Base mínima (pesos) para calcular % vs periodo anterior: con una utilidad
+# previa casi en cero el % no dice nada (0.50 -> 5,000 = 999,900 %)
+DELTA_MIN_BASE = 1
+
+
+def update_period_deltas(db: Session, store_ids: set):
+    """
+    Recalcula sales_vs_previous / profit_vs_previous (% vs el periodo anterior
+    de la misma tienda) al escribir, para que las gráficas solo lean la columna.
+    Un solo UPDATE con LAG() por tienda: un periodo nuevo también corrige el
+    delta del periodo siguiente si llegó fuera de orden.
+    """
+    if not store_ids:
+        return
+    summaries = models.MonthlySummary.__table__
+    window = {"partition_by": summaries.c.store_id, "order_by": period_order(summaries.c.period)}
+    previous = select(
+        summaries.c.id,
+        func.lag(summaries.c.total_sales).over(**window).label("prev_sales"),
+        func.lag(summaries.c.net_profit).over(**window).label("prev_profit")
+    ).where(summaries.c.store_id.in_(store_ids)).subquery()
+
+    def pct_change(current, prev):
+        return case((func.abs(prev) >= DELTA_MIN_BASE, (current - prev) * 100 / func.abs(prev)), else_=None)
+
+    db.execute(
+        update(summaries)
+        .where(summaries.c.id == previous.c.id)
+        .values(
+            sales_vs_previous=pct_change(summaries.c.total_sales, previous.c.prev_sales),
+            profit_vs_previous=pct_change(summaries.c.net_profit, previous.c.prev_profit)
+        )
+    )
+
+
 def extract_financial_data_to_summaries(doc_id: int, db: Session) -> dict:
     """
     Extrae datos financieros de un documento confirmado y los guarda en monthly_summaries.
     Retorna estadísticas del proceso.
     """
-    doc = db.query(models.Document).filter(models.Document.id == doc_id).first()
+    doc = db.scalars(select(models.Document).where(models.Document.id == doc_id)).first()
     if not doc:
         return {"success": False, "error": "Documento no encontrado"}
 
-    raw = db.query(models.RawDocumentData).filter(
+    raw = db.scalars(select(models.RawDocumentData).where(
         models.RawDocumentData.document_id == doc_id
-    ).first()
+    )).first()
 
     if not raw or not raw.raw_json:
         return {"success": False, "error": "Sin datos raw"}
 
-    data = raw.raw_json.get("data", [])
+    data = load_raw_records(raw)
     if not data:
         return {"success": False, "error": "Datos vacíos"}
 
-    # Extraer período del nombre del archivo (P11, P12, P13, etc.)
+    # Extraer período del nombre del archivo (P11, P12, P13, etc.); si no
+    # viene, el que se capturó al confirmar. Sin periodo no se guarda: todos
+    # los archivos sin P## se sobrescribirían en un mismo "2025-P00"
     period_match = re.search(r'P(\d+)', doc.filename)
-    period_num = period_match.group(1) if period_match else "00"
-    period_label = f"2025-P{period_num}"  # Formato: 2025-P11, 2025-P12, etc.
+    if period_match:
+        period_label = f"2025-P{period_match.group(1)}"  # Formato: 2025-P11, 2025-P12, etc.
+    elif doc.period and re.fullmatch(r'\d{4}-P\d+', doc.period):
+        period_label = doc.period
+    else:
+        return {"success": False, "error": "No se detectó el periodo (P##) del documento"}
 
     # Primera fila tiene nombres de tiendas
     header_row = data[0] if data else {}
@@ -1459,7 +2860,7 @@ def extract_financial_data_to_summaries(doc_id: int, db: Session) -> dict:
     stores_data = {}
     for col_key, store_name in store_columns.items():
         stores_data[store_name] = {
-            "store_id": store_name.replace(" ", "_").lower(),
+            "store_id": store_id_from_name(store_name),
             "store_name": store_name,
             "total_sales": 0,
             "cost_of_sales": 0,
@@ -1530,58 +2931,34 @@ def extract_financial_data_to_summaries(doc_id: int, db: Session) -> dict:
             elif first_col_val in ["CFE", "AGUA", "GAS", "TELMEX"]:
                 store_info["utilities"] += val
 
-    # Guardar en monthly_summaries
-    records_created = 0
-    records_updated = 0
-
+    # Guardar en monthly_summaries (UPSERT en un solo statement)
+    rows = []
     for store_name, store_info in stores_data.items():
-        # Verificar si ya existe
-        existing = db.query(models.MonthlySummary).filter(
-            models.MonthlySummary.store_id == store_info["store_id"],
-            models.MonthlySummary.period == period_label
-        ).first()
-
         # Calcular márgenes
         gross_profit = store_info["total_sales"] - store_info["cost_of_sales"]
         gross_margin = (gross_profit / store_info["total_sales"] * 100) if store_info["total_sales"] > 0 else 0
         net_margin = (store_info["net_profit"] / store_info["total_sales"] * 100) if store_info["total_sales"] > 0 else 0
 
-        if existing:
-            # Actualizar
-            existing.total_sales = store_info["total_sales"]
-            existing.cost_of_sales = store_info["cost_of_sales"]
-            existing.gross_profit = gross_profit
-            existing.gross_margin = gross_margin
-            existing.operating_expenses = store_info["operating_expenses"]
-            existing.labor_cost = store_info["labor_cost"]
-            existing.rent = store_info["rent"]
-            existing.utilities = store_info["utilities"]
-            existing.net_profit = store_info["net_profit"]
-            existing.net_margin = net_margin
-            existing.document_id = doc_id
-            records_updated += 1
-        else:
-            # Crear nuevo
-            summary = models.MonthlySummary(
-                store_id=store_info["store_id"],
-                store_name=store_info["store_name"],
-                period=period_label,
-                total_sales=store_info["total_sales"],
-                cost_of_sales=store_info["cost_of_sales"],
-                gross_profit=gross_profit,
-                gross_margin=gross_margin,
-                operating_expenses=store_info["operating_expenses"],
-                labor_cost=store_info["labor_cost"],
-                rent=store_info["rent"],
-                utilities=store_info["utilities"],
-                net_profit=store_info["net_profit"],
-                net_margin=net_margin,
-                document_id=doc_id
-            )
-            db.add(summary)
-            records_created += 1
+        rows.append({
+            "store_id": store_info["store_id"],
+            "store_name": store_info["store_name"],
+            "period": period_label,
+            "total_sales": store_info["total_sales"],
+            "cost_of_sales": store_info["cost_of_sales"],
+            "gross_profit": gross_profit,
+            "gross_margin": gross_margin,
+            "operating_expenses": store_info["operating_expenses"],
+            "labor_cost": store_info["labor_cost"],
+            "rent": store_info["rent"],
+            "utilities": store_info["utilities"],
+            "net_profit": store_info["net_profit"],
+            "net_margin": net_margin,
+            "document_id": doc_id
+        })
 
-    db.commit()
+    upsert_result = upsert_monthly_summaries(rows, db)
+    records_created = upsert_result["created"]
+    records_updated = upsert_result["updated"]
 
     # Validar datos extraídos (sanity checks)
     validation_warnings = []
@@ -1615,7 +2992,7 @@ def extract_financial_data_to_summaries(doc_id: int, db: Session) -> dict:
     }
 
 
-def validate_extraction_with_julia(stores_data: dict, doc_filename: str) -> dict:
+async def validate_extraction_with_julia(stores_data: dict, doc_filename: str) -> dict:
     """
     Usa Julia (IA) para validar que los datos extraídos tengan sentido.
     Retorna análisis y posibles correcciones.
@@ -1650,7 +3027,7 @@ TOTALES:
 Responde en máximo 3 oraciones."""
 
     try:
-        result = call_ai_with_fallback(
+        result = await call_ai_with_fallback(
             messages=[
                 {"role": "system", "content": "Eres Julia, experta en análisis financiero de Little Caesars."},
                 {"role": "user", "content": prompt}
@@ -1723,9 +3100,11 @@ async def confirm_upload(
     Si smart_process=True, usa AI para detectar tipo, período y extraer datos automáticamente.
     PROTEGIDO: Requiere autenticación
     """
-    doc = db.query(models.Document).filter(models.Document.id == confirm_data.doc_id).first()
+    doc = db.scalars(select(models.Document).where(models.Document.id == confirm_data.doc_id)).first()
     if not doc:
         raise HTTPException(status_code=404, detail="Documento no encontrado")
+    if doc.status == "processing":
+        raise HTTPException(status_code=409, detail="El documento aún se está procesando")
 
     # Actualizar documento con metadata del usuario (puede ser sobrescrito por AI)
     doc.store_id = confirm_data.store_id
@@ -1733,9 +3112,14 @@ async def confirm_upload(
     doc.period = confirm_data.period
     doc.uploaded_by = confirm_data.user_uid
     doc.status = "confirmed"
-
     db.commit()
 
+    # Datos de /charts/financial se calculan una vez al confirmar, no en cada
+    # lectura; decodificar el Parquet y extraer va en un hilo con su sesión
+    if doc.file_type != "pdf" and "ESTADO DE RESULTADOS" in doc.filename.upper():
+        await asyncio.to_thread(save_chart_extract, doc.id)
+    dashboard_cache.clear()
+
     # Procesar datos financieros
     extraction_result = None
 
@@ -1789,7 +3173,7 @@ async def smart_process_document(
     Detecta tipo, período, tiendas y extrae datos financieros.
     PROTEGIDO: Requiere autenticación
     """
-    doc = db.query(models.Document).filter(models.Document.id == doc_id).first()
+    doc = db.scalars(select(models.Document).where(models.Document.id == doc_id)).first()
     if not doc:
         raise HTTPException(status_code=404, detail="Documento no encontrado")
 
@@ -1924,14 +3308,14 @@ async def smart_preview_extraction(
     Útil para validar qué extraería la AI antes de confirmar.
     PROTEGIDO: Requiere autenticación
     """
-    doc = db.query(models.Document).filter(models.Document.id == doc_id).first()
+    doc = db.scalars(select(models.Document).where(models.Document.id == doc_id)).first()
     if not doc:
         raise HTTPException(status_code=404, detail="Documento no encontrado")
 
     # Obtener datos del documento
-    raw_data = db.query(models.RawDocumentData).filter(
+    raw_data = db.scalars(select(models.RawDocumentData).where(
         models.RawDocumentData.document_id == doc_id
-    ).first()
+    )).first()
 
     doc_data = db.query(models.DocumentData).filter(
         models.DocumentData.document_id == doc_id
@@ -1979,46 +3363,158 @@ async def smart_preview_extraction(
         raise HTTPException(status_code=500, detail=f"Error en preview: {str(e)}")
 
 
+# Columnas que devuelven los listados de documentos
+DOCUMENT_LIST_COLUMNS = (
+    models.Document.id,
+    models.Document.filename,
+    models.Document.file_type,
+    models.Document.store_id,
+    models.Document.store_name,
+    models.Document.period,
+    models.Document.rows_count,
+    models.Document.status,
+    models.Document.created_at,
+)
+
+
+def document_list_item(d) -> dict:
+    """Fila de DOCUMENT_LIST_COLUMNS -> dict de la respuesta"""
+    return {
+        "id": d.id,
+        "filename": d.filename,
+        "type": d.file_type,
+        "store_id": d.store_id,
+        "store_name": d.store_name,
+        "period": d.period,
+        "rows": d.rows_count,
+        "status": d.status,
+        "created_at": d.created_at.isoformat() if d.created_at else None
+    }
+
+
 @app.get("/documents")
 async def list_documents(
     db: Session = Depends(get_db),
     status: Optional[str] = None,
     store_id: Optional[str] = None,
     limit: int = 50,
+    offset: int = 0,
+    after_id: Optional[int] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """
-    Lista documentos del vault
+    Lista documentos del vault.
+    Paginación por cursor con after_id (= next_cursor de la página anterior):
+    el costo no crece con la página, a diferencia de offset.
     PROTEGIDO: Requiere autenticación
     """
-    query = db.query(models.Document)
+    filters = []
 
     if status:
-        query = query.filter(models.Document.status == status)
+        filters.append(models.Document.status == status)
     if store_id:
-        query = query.filter(models.Document.store_id == store_id)
+        filters.append(models.Document.store_id == store_id)
 
-    docs = query.order_by(desc(models.Document.created_at)).limit(limit).all()
+    order = (desc(models.Document.created_at), desc(models.Document.id))
+
+    if after_id is not None:
+        # Keyset: documentos posteriores al cursor en el orden (created_at, id) DESC
+        cursor_created = (
+            select(models.Document.created_at)
+            .where(models.Document.id == after_id)
+            .scalar_subquery()
+        )
+        keyset = (models.Document.created_at < cursor_created) | (
+            (models.Document.created_at == cursor_created) & (models.Document.id < after_id)
+        )
+        rows = db.execute(
+            select(*DOCUMENT_LIST_COLUMNS).where(*filters, keyset).order_by(*order).limit(limit)
+        ).all()
+        # El total no se recalcula al paginar por cursor
+        total = None
+    else:
+        # Solo las columnas que se serializan (sin columns JSON ni objetos ORM);
+        # count(*) OVER () trae el total junto con la página, sin un segundo query
+        rows = db.execute(
+            select(*DOCUMENT_LIST_COLUMNS, func.count().over().label("total"))
+            .where(*filters).order_by(*order).limit(limit).offset(offset)
+        ).all()
+
+        if rows:
+            total = rows[0].total
+        elif offset > 0:
+            # Página fuera de rango: no hay filas de donde leer el total
+            total = db.scalar(select(func.count()).select_from(models.Document).where(*filters))
+        else:
+            total = 0
 
     return {
-        "count": len(docs),
-        "documents": [
-            {
-                "id": d.id,
-                "filename": d.filename,
-                "type": d.file_type,
-                "store_id": d.store_id,
-                "store_name": d.store_name,
-                "period": d.period,
-                "rows": d.rows_count,
-                "status": d.status,
-                "created_at": d.created_at.isoformat() if d.created_at else None
-            }
-            for d in docs
-        ]
+        "count": len(rows),
+        "total": total,
+        "limit": limit,
+        "offset": offset,
+        "next_cursor": rows[-1].id if len(rows) == limit else None,
+        "documents": [document_list_item(d) for d in rows]
     }
 
 
+def iter_documents_ndjson(filters: list):
+    """
+    Genera una línea JSON por documento leyendo con cursor del servidor
+    (yield_per): la memoria no crece con el número de documentos.
+    Usa su propia sesión porque la del request se cierra antes del streaming.
+    """
+    db = SessionLocal()
+    try:
+        query = (
+            select(*DOCUMENT_LIST_COLUMNS)
+            .where(*filters)
+            .order_by(desc(models.Document.created_at), desc(models.Document.id))
+            .execution_options(yield_per=100)
+        )
+        for d in db.execute(query):
+            yield orjson.dumps(document_list_item(d)) + b"\n"
+    finally:
+        db.close()
+
+
+@app.get("/documents/stream")
+async def stream_documents(
+    status: Optional[str] = None,
+    store_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Todos los documentos como NDJSON (un objeto por línea), sin límite.
+    Para exportaciones grandes; el frontend sigue usando /documents.
+    PROTEGIDO: Requiere autenticación
+    """
+    filters = []
+    if status:
+        filters.append(models.Document.status == status)
+    if store_id:
+        filters.append(models.Document.store_id == store_id)
+
+    return StreamingResponse(iter_documents_ndjson(filters), media_type="application/x-ndjson")
+
+
+@app.get("/documents/{doc_id}/status")
+async def get_document_status(
+    doc_id: int,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Estado de un documento (para polling de uploads en segundo plano)
+    PROTEGIDO: Requiere autenticación
+    """
+    doc = db.get(models.Document, doc_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
+
+    return {"id": doc.id, "status": doc.status, "rows": doc.rows_count}
+
+
 @app.get("/documents/{doc_id}")
 async def get_document(
     doc_id: int,
@@ -2029,13 +3525,17 @@ async def get_document(
     Obtiene detalles de un documento
     PROTEGIDO: Requiere autenticación
     """
-    doc = db.query(models.Document).filter(models.Document.id == doc_id).first()
+    doc = db.scalars(
+        select(models.Document)
+        .options(joinedload(models.Document.raw_data).load_only(
+            models.RawDocumentData.raw_text, models.RawDocumentData.preview_data
+        ))
+        .where(models.Document.id == doc_id)
+    ).first()
     if not doc:
         raise HTTPException(status_code=404, detail="Documento no encontrado")
 
-    raw = db.query(models.RawDocumentData).filter(
-        models.RawDocumentData.document_id == doc_id
-    ).first()
+    raw = doc.raw_data
 
     return {
         "id": doc.id,
@@ -2054,7 +3554,7 @@ async def get_document(
 
 
 @app.get("/documents/{doc_id}/concepts")
-async def get_document_concepts(
+def get_document_concepts(
     doc_id: int,
     db: Session = Depends(get_db),
     current_user: dict = Depends(get_current_user)
@@ -2062,16 +3562,18 @@ async def get_document_concepts(
     """
     Extrae todos los conceptos únicos de un documento para debugging.
     PROTEGIDO: Requiere autenticación
+    Sin await: el parquet y el recorrido de filas corren en el threadpool
     """
-    raw = db.query(models.RawDocumentData).filter(
+    raw = db.scalars(select(models.RawDocumentData).where(
         models.RawDocumentData.document_id == doc_id
-    ).first()
+    )).first()
 
     if not raw or not raw.raw_json:
         raise HTTPException(status_code=404, detail="Datos no encontrados")
 
-    data = raw.raw_json.get("data", [])
-    concepts = []
+    data = load_raw_records(raw)
+    # dict como conjunto ordenado: O(1) por concepto en lugar de buscar en la lista
+    concepts = {}
 
     for i, row in enumerate(data):
         # Buscar el concepto en la primera columna
@@ -2081,14 +3583,14 @@ async def get_document_concepts(
                 first_val = str(val).strip()
                 break
 
-        if first_val and first_val not in concepts:
-            concepts.append(first_val)
+        if first_val:
+            concepts.setdefault(first_val)
 
     return {
         "document_id": doc_id,
         "total_rows": len(data),
         "unique_concepts": len(concepts),
-        "concepts": concepts
+        "concepts": list(concepts)
     }
 
 
@@ -2102,20 +3604,18 @@ async def delete_document(
     Elimina un documento del vault
     PROTEGIDO: Requiere autenticación
     """
-    doc = db.query(models.Document).filter(models.Document.id == doc_id).first()
-    if not doc:
+    if IS_SQLITE:
+        # SQLite no aplica ON DELETE CASCADE (foreign_keys desactivado): borrar a mano
+        db.execute(delete(models.RawDocumentData).where(models.RawDocumentData.document_id == doc_id))
+        db.execute(delete(models.FinancialRecord).where(models.FinancialRecord.document_id == doc_id))
+
+    # Un solo DELETE: raw_document_data y financial_records caen por ON DELETE CASCADE
+    deleted = db.execute(delete(models.Document).where(models.Document.id == doc_id)).rowcount
+    if not deleted:
+        db.rollback()
         raise HTTPException(status_code=404, detail="Documento no encontrado")
-
-    # Eliminar datos relacionados
-    db.query(models.RawDocumentData).filter(
-        models.RawDocumentData.document_id == doc_id
-    ).delete()
-    db.query(models.FinancialRecord).filter(
-        models.FinancialRecord.document_id == doc_id
-    ).delete()
-
-    db.delete(doc)
     db.commit()
+    dashboard_cache.clear()
 
     return {"success": True, "message": f"Documento {doc_id} eliminado"}
 
@@ -2124,42 +3624,92 @@ async def delete_document(
 # ANÁLISIS CON IA (FALLBACK AUTOMÁTICO)
 # ============================================
 
-@app.post("/analyze/{doc_id}")
-async def analyze_document(
-    doc_id: int,
-    analysis_type: str = "general",
-    db: Session = Depends(get_db),
-    current_user: dict = Depends(get_current_user)
-):
+# Contexto de /analyze: en lugar de los primeros 8000 caracteres o 20 filas fijas,
+# solo las partes del documento que tienen que ver con el tipo de análisis
+ANALYZE_TEXT_MAX_CHARS = 4000   # PDFs más cortos van completos
+ANALYZE_CHUNK_CHARS = 800
+ANALYZE_TOP_CHUNKS = 5
+ANALYZE_MAX_ROWS = 20
+ANALYSIS_KEYWORDS_RE = {
+    "general": re.compile(r"VENTA|INGRESO|COSTO|GASTO|UTILIDAD|MARGEN|TOTAL", re.IGNORECASE),
+    "pl": re.compile(
+        r"VENTA|INGRESO|COSTO|GASTO|UTILIDAD|MARGEN|NOMINA|SUELDO|RENTA|OPERACI|IMPUESTO",
+        re.IGNORECASE
+    ),
+}
+
+
+def split_text_chunks(text: str, chunk_chars: int = ANALYZE_CHUNK_CHARS) -> list:
+    """Parte el texto en bloques de ~chunk_chars respetando saltos de línea"""
+    chunks = []
+    current = []
+    size = 0
+    for line in text.splitlines():
+        if size + len(line) > chunk_chars and current:
+            chunks.append("\n".join(current))
+            current = []
+            size = 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def select_relevant_text(text: str, analysis_type: str) -> str:
     """
-    Analiza un documento con IA (OpenAI/Anthropic con fallback)
-    PROTEGIDO: Requiere autenticación
+    Top-k bloques del texto con más conceptos del tipo de análisis, en su
+    orden original. Texto corto se devuelve completo.
     """
-    if not openai_client and not anthropic_client:
-        raise HTTPException(status_code=503, detail="No hay proveedores de IA configurados")
-
-    doc = db.query(models.Document).filter(models.Document.id == doc_id).first()
-    if not doc:
-        raise HTTPException(status_code=404, detail="Documento no encontrado")
-
-    raw = db.query(models.RawDocumentData).filter(
-        models.RawDocumentData.document_id == doc_id
+    if len(text) <= ANALYZE_TEXT_MAX_CHARS:
+        return text
+    keywords = ANALYSIS_KEYWORDS_RE.get(analysis_type, ANALYSIS_KEYWORDS_RE["general"])
+    chunks = split_text_chunks(text)
+    ranked = sorted(range(len(chunks)), key=lambda i: (-len(keywords.findall(chunks[i])), i))
+    return "\n[...]\n".join(chunks[i] for i in sorted(ranked[:ANALYZE_TOP_CHUNKS]))
+
+
+def summarize_dataframe(df: pd.DataFrame, analysis_type: str) -> str:
+    """Estadísticas de las columnas numéricas + filas cuyo concepto coincide con el análisis"""
+    if df.empty:
+        return "Sin datos"
+    keywords = ANALYSIS_KEYWORDS_RE.get(analysis_type, ANALYSIS_KEYWORDS_RE["general"])
+    labels = df.iloc[:, 0].astype(str)
+    matching = df[labels.str.contains(keywords, na=False)]
+    rows = matching if not matching.empty else df
+    parts = [rows.head(ANALYZE_MAX_ROWS).to_string()]
+
+    numeric = df.select_dtypes(include="number")
+    if not numeric.empty:
+        parts.append("Estadísticas:\n" + numeric.describe().round(2).to_string())
+    return "\n\n".join(parts)
+
+
+def load_document_summary(db: Session, doc_id: int, analysis_type: str = "general") -> tuple:
+    """(documento, resumen de sus datos para el prompt) o (None, None) si no existe"""
+    # Documento y datos raw en un solo round trip (LEFT JOIN)
+    doc = db.scalars(
+        select(models.Document)
+        .options(joinedload(models.Document.raw_data))
+        .where(models.Document.id == doc_id)
     ).first()
+    if not doc:
+        return None, None
 
-    try:
-        if doc.file_type == "pdf":
-            data_summary = f"""
+    raw = doc.raw_data
+    if doc.file_type == "pdf":
+        data_summary = f"""
             Archivo: {doc.filename}
             Sucursal: {doc.store_name or 'No especificada'}
             Periodo: {doc.period or 'No especificado'}
             Tipo: PDF (Estado de Resultados)
 
             Contenido:
-            {raw.raw_text[:8000] if raw else 'Sin datos'}
+            {select_relevant_text(raw.raw_text or '', analysis_type) if raw else 'Sin datos'}
             """
-        else:
-            df = pd.DataFrame(raw.raw_json) if raw and raw.raw_json else pd.DataFrame()
-            data_summary = f"""
+    else:
+        df = load_raw_dataframe(raw)
+        data_summary = f"""
             Archivo: {doc.filename}
             Sucursal: {doc.store_name or 'No especificada'}
             Periodo: {doc.period or 'No especificado'}
@@ -2167,9 +3717,35 @@ async def analyze_document(
             Columnas: {', '.join(df.columns.tolist()) if not df.empty else 'N/A'}
 
             Datos:
-            {df.head(20).to_string() if not df.empty else 'Sin datos'}
+            {summarize_dataframe(df, analysis_type)}
             """
+    return doc, data_summary
+
+
+@app.post("/analyze/{doc_id}")
+async def analyze_document(
+    doc_id: int,
+    http_request: Request,
+    analysis_type: str = "general",
+    stream: bool = Query(default=False, description="Responder con Server-Sent Events"),
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Analiza un documento con IA (OpenAI/Anthropic con fallback)
+    PROTEGIDO: Requiere autenticación
+    """
+    if not openai_client and not anthropic_client:
+        raise HTTPException(status_code=503, detail="No hay proveedores de IA configurados")
 
+    # Consulta y lectura del parquet son bloqueantes: en un hilo
+    doc, data_summary = await asyncio.to_thread(load_document_summary, db, doc_id, analysis_type)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
+    filename = doc.filename
+    store_id = doc.store_id
+
+    try:
         prompts = {
             "general": f"""
             Analiza estos datos financieros de Little Caesars:
@@ -2209,25 +3785,63 @@ async def analyze_document(
             {"role": "system", "content": "Eres Julia, experta en análisis financiero para restaurantes Little Caesars. Respondes en español de manera profesional."},
             {"role": "user", "content": prompt}
         ]
-        ai_response = call_ai_with_fallback(messages, max_tokens=2000, temperature=0.7)
+
+        # El prompt sale del documento y el tipo de análisis: basta la llave exacta
+        cache_scope = ai_cache_scope(messages)
+        cached = ai_response_cache.get_exact(cache_scope, analysis_type)
+
+        if wants_event_stream(http_request, stream):
+            if cached is not None:
+                return sse_response(cached_sse_response(cached))
+
+            def on_complete(text, tokens):
+                ai_response_cache.put(cache_scope, analysis_type, None, {"response": text, "provider": "cache"})
+                save_analysis_record(
+                    document_id=doc_id,
+                    store_id=store_id,
+                    analysis_type=analysis_type,
+                    query=f"Análisis {analysis_type}",
+                    result=text,
+                    tokens_used=tokens
+                )
+
+            return sse_response(
+                stream_ai_with_fallback(messages, on_complete, max_tokens=2000, temperature=0.7)
+            )
+
+        if cached is not None:
+            return {
+                "success": True,
+                "analysis": {
+                    "doc_id": doc_id,
+                    "filename": filename,
+                    "type": analysis_type,
+                    "result": cached["response"],
+                    "tokens_used": 0,
+                    "provider": cached["provider"],
+                    "cached": True
+                }
+            }
+
+        ai_response = await call_ai_with_fallback(messages, max_tokens=2000, temperature=0.7)
+        ai_response_cache.put(cache_scope, analysis_type, None, ai_response)
 
         # Guardar análisis en DB
-        analysis = models.Analysis(
+        await asyncio.to_thread(
+            save_analysis_record,
             document_id=doc_id,
-            store_id=doc.store_id,
+            store_id=store_id,
             analysis_type=analysis_type,
             query=f"Análisis {analysis_type}",
             result=ai_response["response"],
             tokens_used=ai_response["tokens_used"]
         )
-        db.add(analysis)
-        db.commit()
 
         return {
             "success": True,
             "analysis": {
                 "doc_id": doc_id,
-                "filename": doc.filename,
+                "filename": filename,
                 "type": analysis_type,
                 "result": ai_response["response"],
                 "tokens_used": ai_response["tokens_used"],
@@ -2244,9 +3858,69 @@ async def analyze_document(
 # CHAT CON JULIA
 # ============================================
 
+def build_chat_context(db: Session, base_context: str, store_id: Optional[str]) -> str:
+    """Contexto del vault para el prompt de Julia (consultas síncronas: se llama en un hilo)"""
+    # Partes en una lista y un solo join al final (sin += sobre el string completo)
+    # El contexto que manda el cliente también se acota
+    parts = [(base_context or "")[:CHAT_BASE_CONTEXT_MAX_CHARS]]
+
+    # Documentos confirmados con su preview en una sola consulta (LEFT JOIN;
+    # raw_data es uno a uno, el LIMIT aplica igual); raw_json/raw_parquet no se cargan
+    docs_query = db.query(models.Document).options(
+        joinedload(models.Document.raw_data).load_only(
+            models.RawDocumentData.raw_text, models.RawDocumentData.preview_data
+        )
+    ).filter(
+        models.Document.status == "confirmed"
+    )
+    if store_id:
+        docs_query = docs_query.filter(models.Document.store_id == store_id)
+
+    docs = docs_query.order_by(desc(models.Document.created_at)).limit(10).all()
+
+    if docs:
+        parts.append("\n\nDocumentos en el vault:\n")
+        # Empacar documentos (del más reciente al más viejo) hasta llenar el presupuesto
+        tokens_left = CHAT_CONTEXT_TOKEN_BUDGET
+        for doc in docs:
+            doc_parts = [f"- {doc.filename}: {doc.store_name or 'Sin sucursal'}, {doc.period or 'Sin periodo'}, {doc.rows_count} filas\n"]
+
+            # Incluir preview de datos
+            raw = doc.raw_data
+
+            if raw:
+                if doc.file_type == "pdf" and raw.raw_text:
+                    doc_parts.append(f"  Contenido:\n{raw.raw_text[:3000]}\n")
+                elif raw.preview_data:
+                    doc_parts.append(f"  Datos: {dumps_json(raw.preview_data[:5])}\n")
+
+            doc_context = "".join(doc_parts)
+            doc_tokens = count_tokens(doc_context)
+            if doc_tokens > tokens_left:
+                break
+            tokens_left -= doc_tokens
+            parts.append(doc_context)
+
+    # Obtener resúmenes mensuales si existen
+    summaries = db.query(models.MonthlySummary).order_by(
+        *period_order(models.MonthlySummary.period, descending=True)
+    ).limit(5).all()
+
+    if summaries:
+        parts.append("\n\nResúmenes mensuales:\n")
+        parts.extend(
+            f"- {s.store_name} ({s.period}): Ventas ${s.total_sales:,.2f}, Utilidad ${s.net_profit:,.2f}\n"
+            for s in summaries
+        )
+
+    return "".join(parts)
+
+
 @app.post("/chat")
 async def chat_with_julia(
     request: schemas.ChatRequest,
+    http_request: Request,
+    stream: bool = Query(default=False, description="Responder con Server-Sent Events"),
     db: Session = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
@@ -2260,43 +3934,8 @@ async def chat_with_julia(
         raise HTTPException(status_code=503, detail="No hay proveedores de IA configurados")
 
     try:
-        # Construir contexto con datos del vault
-        data_context = request.context or ""
-
-        # Obtener documentos confirmados
-        docs_query = db.query(models.Document).filter(
-            models.Document.status == "confirmed"
-        )
-        if request.store_id:
-            docs_query = docs_query.filter(models.Document.store_id == request.store_id)
-
-        docs = docs_query.order_by(desc(models.Document.created_at)).limit(10).all()
-
-        if docs:
-            data_context += "\n\nDocumentos en el vault:\n"
-            for doc in docs:
-                data_context += f"- {doc.filename}: {doc.store_name or 'Sin sucursal'}, {doc.period or 'Sin periodo'}, {doc.rows_count} filas\n"
-
-                # Incluir preview de datos
-                raw = db.query(models.RawDocumentData).filter(
-                    models.RawDocumentData.document_id == doc.id
-                ).first()
-
-                if raw:
-                    if doc.file_type == "pdf" and raw.raw_text:
-                        data_context += f"  Contenido:\n{raw.raw_text[:3000]}\n"
-                    elif raw.preview_data:
-                        data_context += f"  Datos: {json.dumps(raw.preview_data[:5], ensure_ascii=False)}\n"
-
-        # Obtener resúmenes mensuales si existen
-        summaries = db.query(models.MonthlySummary).order_by(
-            desc(models.MonthlySummary.period)
-        ).limit(5).all()
-
-        if summaries:
-            data_context += "\n\nResúmenes mensuales:\n"
-            for s in summaries:
-                data_context += f"- {s.store_name} ({s.period}): Ventas ${s.total_sales:,.2f}, Utilidad ${s.net_profit:,.2f}\n"
+        # Construir contexto con datos del vault (consultas fuera del event loop)
+        data_context = await asyncio.to_thread(build_chat_context, db, request.context, request.store_id)
 
         messages = [
             {
@@ -2325,21 +3964,57 @@ Si no tienes datos suficientes, sugiere amablemente que suban los documentos nec
                 "content": msg.get("content", "")
             })
 
+        # Preguntas equivalentes con el mismo contexto reutilizan la respuesta
+        cache_scope = ai_cache_scope(messages)
+        store_names = await asyncio.to_thread(known_store_names, db)
+        entities = question_entities(request.message, store_names)
+        cached, question_embedding = await find_cached_ai_response(cache_scope, request.message, entities)
+
         messages.append({"role": "user", "content": request.message})
 
+        if wants_event_stream(http_request, stream):
+            if cached is not None:
+                return sse_response(cached_sse_response(cached))
+
+            def on_complete(text, tokens):
+                ai_response_cache.put(
+                    cache_scope, request.message, question_embedding,
+                    {"response": text, "provider": "cache"}, entities
+                )
+                save_analysis_record(
+                    store_id=request.store_id,
+                    analysis_type="chat",
+                    query=request.message,
+                    result=text,
+                    tokens_used=tokens
+                )
+
+            return sse_response(
+                stream_ai_with_fallback(messages, on_complete, max_tokens=1500, temperature=0.7)
+            )
+
+        if cached is not None:
+            return {
+                "success": True,
+                "response": cached["response"],
+                "tokens_used": 0,
+                "provider": cached["provider"],
+                "cached": True
+            }
+
         # Usar helper con fallback automático
-        ai_response = call_ai_with_fallback(messages, max_tokens=1500, temperature=0.7)
+        ai_response = await call_ai_with_fallback(messages, max_tokens=1500, temperature=0.7)
+        ai_response_cache.put(cache_scope, request.message, question_embedding, ai_response, entities)
 
         # Guardar en análisis
-        analysis = models.Analysis(
+        await asyncio.to_thread(
+            save_analysis_record,
             store_id=request.store_id,
             analysis_type="chat",
             query=request.message,
             result=ai_response["response"],
             tokens_used=ai_response["tokens_used"]
         )
-        db.add(analysis)
-        db.commit()
 
         return {
             "success": True,
@@ -2359,6 +4034,25 @@ Si no tienes datos suficientes, sugiere amablemente que suban los documentos nec
 # VAULT - Resumen y Queries
 # ============================================
 
+def json_rows(query, *columns: str):
+    """
+    Subconsulta escalar con las filas de query como arreglo JSON de objetos
+    {columna: valor}. Permite traer varias secciones en una sola consulta.
+    """
+    sub = query.subquery()
+    pairs = []
+    for name in columns:
+        # Llave como literal SQL (nombres fijos del código), no como parámetro
+        pairs += [literal_column(f"'{name}'"), sub.c[name]]
+    if IS_SQLITE:
+        aggregated = func.json_group_array(func.json_object(*pairs))
+    else:
+        # json_agg de cero filas es NULL
+        aggregated = func.coalesce(func.json_agg(func.json_build_object(*pairs)), text("'[]'::json"))
+    # type_coerce (sin CAST en SQL): SQLAlchemy decodifica el JSON al leer
+    return type_coerce(select(aggregated).select_from(sub).scalar_subquery(), JSON)
+
+
 @app.get("/vault/summary")
 async def get_vault_summary(
     db: Session = Depends(get_db),
@@ -2368,44 +4062,44 @@ async def get_vault_summary(
     Resumen del vault
     PROTEGIDO: Requiere autenticación
     """
-    total_docs = db.query(models.Document).filter(
-        models.Document.status == "confirmed"
-    ).count()
+    def compute():
+        # Conteos y recientes en una sola consulta (mismo esquema que /dashboard/stats)
+        confirmed_docs = select(
+            models.Document.id,
+            models.Document.filename,
+            models.Document.store_id,
+            models.Document.store_name,
+            models.Document.period,
+            models.Document.file_type,
+            models.Document.created_at
+        ).where(models.Document.status == "confirmed").cte("confirmed_docs")
+
+        counts = union_all(
+            select(
+                literal("type").label("kind"),
+                confirmed_docs.c.file_type.label("key"),
+                func.count().label("total")
+            ).group_by(confirmed_docs.c.file_type),
+            select(literal("stores"), null().cast(String), func.count(func.distinct(confirmed_docs.c.store_id))),
+        )
+        recent = select(confirmed_docs).order_by(desc(confirmed_docs.c.created_at)).limit(5)
 
-    # Contar por tipo
-    type_counts = db.query(
-        models.Document.file_type,
-        func.count(models.Document.id)
-    ).filter(
-        models.Document.status == "confirmed"
-    ).group_by(models.Document.file_type).all()
+        row = db.execute(select(
+            json_rows(counts, "kind", "key", "total").label("counts"),
+            json_rows(recent, "id", "filename", "store_name", "period", "created_at").label("recent"),
+        )).one()
 
-    # Sucursales únicas
-    stores = db.query(models.Document.store_id).filter(
-        models.Document.status == "confirmed",
-        models.Document.store_id.isnot(None)
-    ).distinct().count()
+        type_counts = [(c["key"], c["total"]) for c in row.counts if c["kind"] == "type"]
 
-    # Documentos recientes
-    recent = db.query(models.Document).filter(
-        models.Document.status == "confirmed"
-    ).order_by(desc(models.Document.created_at)).limit(5).all()
+        return {
+            "total_documents": sum(total for _, total in type_counts),
+            "total_stores": next((c["total"] for c in row.counts if c["kind"] == "stores"), 0),
+            "documents_by_type": dict(type_counts),
+            # El orden dentro de un agregado JSON no está garantizado: se reordena aquí
+            "recent_documents": sorted(row.recent, key=lambda d: d["created_at"] or "", reverse=True)
+        }
 
-    return {
-        "total_documents": total_docs,
-        "total_stores": stores,
-        "documents_by_type": {t[0]: t[1] for t in type_counts},
-        "recent_documents": [
-            {
-                "id": d.id,
-                "filename": d.filename,
-                "store_name": d.store_name,
-                "period": d.period,
-                "created_at": d.created_at.isoformat() if d.created_at else None
-            }
-            for d in recent
-        ]
-    }
+    return await dashboard_cache.get_or_compute("vault_summary", compute)
 
 
 @app.get("/vault/stores")
@@ -2417,25 +4111,28 @@ async def get_stores(
     Lista sucursales con datos
     PROTEGIDO: Requiere autenticación
     """
-    stores = db.query(
-        models.Document.store_id,
-        models.Document.store_name,
-        func.count(models.Document.id).label("doc_count")
-    ).filter(
-        models.Document.status == "confirmed",
-        models.Document.store_id.isnot(None)
-    ).group_by(
-        models.Document.store_id,
-        models.Document.store_name
-    ).all()
+    def compute():
+        stores = db.query(
+            models.Document.store_id,
+            models.Document.store_name,
+            func.count(models.Document.id).label("doc_count")
+        ).filter(
+            models.Document.status == "confirmed",
+            models.Document.store_id.isnot(None)
+        ).group_by(
+            models.Document.store_id,
+            models.Document.store_name
+        ).all()
 
-    return {
-        "count": len(stores),
-        "stores": [
-            {"store_id": s[0], "store_name": s[1], "documents": s[2]}
-            for s in stores
-        ]
-    }
+        return {
+            "count": len(stores),
+            "stores": [
+                {"store_id": s[0], "store_name": s[1], "documents": s[2]}
+                for s in stores
+            ]
+        }
+
+    return await dashboard_cache.get_or_compute("vault_stores", compute)
 
 
 @app.get("/analyses")
@@ -2481,108 +4178,299 @@ async def get_dashboard_stats(
     Estadísticas para el dashboard principal
     PROTEGIDO: Requiere autenticación
     """
+    def compute():
+        # Todo el dashboard en UNA sola consulta: cada sección es una subconsulta
+        # agregada como arreglo JSON, sobre un CTE de documentos confirmados
+        confirmed_docs = select(
+            models.Document.id,
+            models.Document.filename,
+            models.Document.store_id,
+            models.Document.store_name,
+            models.Document.period,
+            models.Document.file_type,
+            models.Document.created_at
+        ).where(models.Document.status == "confirmed").cte("confirmed_docs")
+
+        counts = union_all(
+            select(
+                literal("type").label("kind"),
+                confirmed_docs.c.file_type.label("key"),
+                func.count().label("total")
+            ).group_by(confirmed_docs.c.file_type),
+            select(literal("stores"), null().cast(String), func.count(func.distinct(confirmed_docs.c.store_id))),
+            select(literal("analyses"), null().cast(String), func.count()).select_from(models.Analysis),
+        )
+        recent = select(confirmed_docs).order_by(desc(confirmed_docs.c.created_at)).limit(5)
+        top = select(
+            confirmed_docs.c.store_id,
+            confirmed_docs.c.store_name,
+            func.count().label("documents")
+        ).where(
+            confirmed_docs.c.store_id.isnot(None)
+        ).group_by(
+            confirmed_docs.c.store_id,
+            confirmed_docs.c.store_name
+        ).order_by(desc("documents")).limit(5)
+        monthly = select(
+            models.MonthlySummary.period,
+            models.MonthlySummary.store_name,
+            models.MonthlySummary.total_sales,
+            models.MonthlySummary.net_profit,
+            models.MonthlySummary.gross_margin,
+            models.MonthlySummary.net_margin
+        ).order_by(*period_order(models.MonthlySummary.period, descending=True)).limit(6)
+
+        row = db.execute(select(
+            json_rows(counts, "kind", "key", "total").label("counts"),
+            json_rows(recent, "id", "filename", "store_name", "period", "file_type", "created_at").label("recent"),
+            json_rows(top, "store_id", "store_name", "documents").label("top"),
+            json_rows(
+                monthly, "period", "store_name", "total_sales", "net_profit", "gross_margin", "net_margin"
+            ).label("monthly"),
+        )).one()
+
+        type_counts = [(c["key"], c["total"]) for c in row.counts if c["kind"] == "type"]
+        total_docs = sum(total for _, total in type_counts)
+        total_stores = next((c["total"] for c in row.counts if c["kind"] == "stores"), 0)
+        total_analyses = next((c["total"] for c in row.counts if c["kind"] == "analyses"), 0)
+
+        # El orden dentro de un agregado JSON no está garantizado: se reordena aquí
+        recent_docs = sorted(row.recent, key=lambda d: d["created_at"] or "", reverse=True)
+        top_stores = sorted(row.top, key=lambda s: s["documents"], reverse=True)
+        monthly_data = sorted(row.monthly, key=lambda m: period_sort_key(m["period"]), reverse=True)
 
-    # Total documentos confirmados
-    total_docs = db.query(models.Document).filter(
-        models.Document.status == "confirmed"
-    ).count()
+        return {
+            "total_documents": total_docs,
+            "total_stores": total_stores,
+            "total_analyses": total_analyses,
+            "documents_by_type": {
+                t[0] if t[0] else "otros": t[1] for t in type_counts
+            },
+            "recent_documents": [
+                {
+                    "id": d["id"],
+                    "filename": d["filename"],
+                    "store_name": d["store_name"],
+                    "period": d["period"],
+                    "type": d["file_type"],
+                    "created_at": d["created_at"]
+                }
+                for d in recent_docs
+            ],
+            "top_stores": top_stores,
+            "monthly_summaries": monthly_data
+        }
 
-    # Total sucursales únicas
-    total_stores = db.query(models.Document.store_id).filter(
-        models.Document.status == "confirmed",
-        models.Document.store_id.isnot(None)
-    ).distinct().count()
+    return await dashboard_cache.get_or_compute("dashboard_stats", compute)
 
-    # Total análisis realizados
-    total_analyses = db.query(models.Analysis).count()
 
-    # Documentos por tipo
-    type_counts = db.query(
-        models.Document.file_type,
-        func.count(models.Document.id)
-    ).filter(
-        models.Document.status == "confirmed"
-    ).group_by(models.Document.file_type).all()
+# ============================================
+# CHARTS - Datos para gráficas en vivo
+# ============================================
 
-    # Documentos recientes (últimos 5)
-    recent_docs = db.query(models.Document).filter(
-        models.Document.status == "confirmed"
-    ).order_by(desc(models.Document.created_at)).limit(5).all()
+# Categorías de gasto de /charts/financial. Cada alternativa es un lookahead
+# anclado al inicio: gana el primer grupo (en este orden) presente en el concepto,
+# y solo ese grupo queda capturado
+CHART_CATEGORY_RE = re.compile(
+    r'^(?:(?=.*?(?P<nomina>NOMINA|SALARIO|SUELDO))'
+    r'|(?=.*?(?P<renta>RENTA|ALQUILER))'
+    r'|(?=.*?(?P<servicios>LUZ|ELECTRICIDAD|CFE))'
+    r'|(?=.*?(?P<costo>COSTO|INGREDIENTE|MATERIA)))',
+    re.DOTALL
+)
+CHART_CATEGORIES = {
+    "nomina": "Nómina",
+    "renta": "Renta",
+    "servicios": "Servicios",
+    "costo": "Costo de Venta",
+}
 
-    # Sucursales con más documentos
-    top_stores = db.query(
-        models.Document.store_id,
-        models.Document.store_name,
-        func.count(models.Document.id).label("doc_count")
-    ).filter(
-        models.Document.status == "confirmed",
-        models.Document.store_id.isnot(None)
-    ).group_by(
-        models.Document.store_id,
-        models.Document.store_name
-    ).order_by(desc("doc_count")).limit(5).all()
 
-    # Resúmenes mensuales si existen
-    monthly_data = db.query(models.MonthlySummary).order_by(
-        desc(models.MonthlySummary.period)
-    ).limit(6).all()
+def _python_number(value):
+    """Escalar de NumPy -> int/float de Python (serializable en JSON)"""
+    return value.item() if isinstance(value, np.generic) else value
 
-    return {
-        "total_documents": total_docs,
-        "total_stores": total_stores,
-        "total_analyses": total_analyses,
-        "documents_by_type": {
-            t[0] if t[0] else "otros": t[1] for t in type_counts
-        },
-        "recent_documents": [
-            {
-                "id": d.id,
-                "filename": d.filename,
-                "store_name": d.store_name,
-                "period": d.period,
-                "type": d.file_type,
-                "created_at": d.created_at.isoformat() if d.created_at else None
-            }
-            for d in recent_docs
-        ],
-        "top_stores": [
-            {
-                "store_id": s[0],
-                "store_name": s[1],
-                "documents": s[2]
-            }
-            for s in top_stores
-        ],
-        "monthly_summaries": [
-            {
-                "period": m.period,
-                "store_name": m.store_name,
-                "total_sales": m.total_sales,
-                "net_profit": m.net_profit,
-                "gross_margin": m.gross_margin,
-                "net_margin": m.net_margin
-            }
-            for m in monthly_data
-        ] if monthly_data else []
+
+def _is_python_number(value) -> bool:
+    return isinstance(value, (int, float, np.number))
+
+
+def extract_chart_data(df: pd.DataFrame) -> dict:
+    """
+    Extrae de un Estado de Resultados los valores para /charts/financial:
+    {"stores": {tienda: {ingresos/egresos/utilidad encontrados}},
+     "total_ingresos", "total_egresos", "categories"}
+    Trabaja sobre el DataFrame completo con máscaras en lugar de recorrer
+    cada celda de cada fila como dict.
+    """
+    stores_data = {}
+    total_ingresos = 0
+    total_egresos = 0
+    categories = {}
+    result = {
+        "stores": stores_data,
+        "total_ingresos": total_ingresos,
+        "total_egresos": total_egresos,
+        "categories": categories
     }
+    if df.empty:
+        return result
 
+    df = df.replace([np.inf, -np.inf], np.nan)
+
+    # Primera fila tiene nombres de tiendas (columnas que no son % ni Unnamed)
+    store_names = [
+        val for key, val in df.iloc[0].items()
+        if isinstance(val, str) and val and val != "%" and "Unnamed" not in str(key)
+    ]
+
+    # Concepto de cada fila = primera columna; filas sin concepto se ignoran
+    first_col = df.iloc[:, 0]
+    row_ok = (first_col.notna() & (first_col != 0) & (first_col != "")).to_numpy()
+    labels = first_col.astype(str).str.upper().str.strip()
+
+    named = df.loc[:, ["Unnamed" not in str(col) for col in df.columns]]
+    values = named.to_numpy(dtype=object)
+    # Celdas con valor (no None/NaN, 0 ni ""): cada una avanza el índice de tienda
+    truthy = pd.notna(values) & (values != 0) & (values != "")
+    numeric = np.column_stack([
+        np.ones(len(named), dtype=bool) if pd.api.types.is_numeric_dtype(col)
+        else col.map(_is_python_number).to_numpy(dtype=bool)
+        for _, col in named.items()
+    ])
+    store_index = np.cumsum(truthy, axis=1) - 1
+    valid = truthy & numeric & (store_index < len(store_names)) & row_ok[:, None]
+
+    # Tiendas en el orden en que aparecen (recorrido por filas)
+    rows, cols = np.nonzero(valid)
+    for idx in pd.unique(store_index[rows, cols]):
+        stores_data.setdefault(store_names[idx], {})
+
+    is_ingresos = ((labels == "INGRESOS") | labels.str.contains("VENTA", regex=False)).to_numpy()
+    is_egresos = labels.isin(["TOTAL EGRESOS", "EGRESOS"]).to_numpy() & ~is_ingresos
+    is_utilidad = (
+        labels.str.contains("UTILIDAD", regex=False) & labels.str.contains("NETA", regex=False)
+    ).to_numpy() & ~is_ingresos & ~is_egresos
+
+    # Solo las celdas de estas filas (pocas) se asignan una por una; la última gana
+    for field, row_mask in (("ingresos", is_ingresos), ("egresos", is_egresos), ("utilidad", is_utilidad)):
+        for r, c in zip(*np.nonzero(valid & row_mask[:, None])):
+            val = _python_number(values[r, c])
+            stores_data[store_names[store_index[r, c]]][field] = val
+            if field == "ingresos":
+                total_ingresos += val
+            elif field == "egresos":
+                total_egresos += val
+
+    # Categorizar gastos: una sola pasada del regex por fila
+    matched = labels.str.extract(CHART_CATEGORY_RE)
+    for group, category in CHART_CATEGORIES.items():
+        row_mask = matched[group].notna().to_numpy()
+        cells = values[valid & row_mask[:, None]]
+        if cells.size:
+            categories[category] = _python_number(cells.sum())
+
+    result["total_ingresos"] = total_ingresos
+    result["total_egresos"] = total_egresos
+    return result
+
+
+def store_chart_extract(raw) -> Optional[dict]:
+    """
+    Calcula y guarda en raw_json["chart_extract"] los datos de gráficas del
+    documento, para no re-leer los datos completos en cada request.
+    """
+    df = load_raw_dataframe(raw)
+    if df.empty:
+        return None
+    extract = extract_chart_data(df)
+    # Reasignar (no mutar) para que SQLAlchemy detecte el cambio en la columna JSON
+    raw.raw_json = {**(raw.raw_json or {}), "chart_extract": extract}
+    return extract
+
+
+def save_chart_extract(doc_id: int):
+    """Calcula y guarda el extracto de gráficas de un documento con su propia sesión (para correr en un hilo)"""
+    db = SessionLocal()
+    try:
+        raw = db.scalars(select(models.RawDocumentData).where(
+            models.RawDocumentData.document_id == doc_id
+        )).first()
+        if raw and raw.raw_json:
+            store_chart_extract(raw)
+            db.commit()
+    except Exception as e:
+        # No bloquea la confirmación: /charts/financial lo calcula si falta
+        db.rollback()
+        print(f"⚠️ No se pudo calcular el extracto de gráficas del documento {doc_id}: {e}")
+    finally:
+        db.close()
+
+
+# Último resultado de /charts/financial: (etag, expira, payload). No depende del
+# usuario, así que basta una entrada; un ETag distinto la reemplaza
+CHARTS_FINANCIAL_TTL_SECONDS = 60
+_charts_financial_cache = None
+
+
+def charts_financial_etag(db: Session) -> str:
+    """
+    ETag de /charts/financial: hash de (id, updated_at) de los documentos que
+    entran en las gráficas. Solo cambia al confirmar, editar o borrar uno.
+    """
+    versions = db.execute(
+        select(models.Document.id, models.Document.updated_at)
+        .where(
+            models.Document.status == "confirmed",
+            models.Document.filename.ilike("%ESTADO DE RESULTADOS%")
+        )
+        .order_by(desc(models.Document.created_at))
+        .limit(5)
+    ).all()
+    digest = hashlib.sha256(
+        orjson.dumps(sorted((doc_id, str(updated_at)) for doc_id, updated_at in versions))
+    ).hexdigest()
+    return f'"{digest}"'
 
-# ============================================
-# CHARTS - Datos para gráficas en vivo
-# ============================================
 
 @app.get("/charts/financial")
-async def get_charts_financial_data(
+def get_charts_financial_data(
+    request: Request,
     db: Session = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     """
     Extrae datos financieros de los documentos para las gráficas
     PROTEGIDO: Requiere autenticación
+    Sin await: FastAPI la corre en su threadpool y las consultas no bloquean el event loop
+    Responde 304 si el cliente ya tiene la versión actual (If-None-Match)
     """
+    global _charts_financial_cache
+
+    etag = charts_financial_etag(db)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    cached = _charts_financial_cache
+    if cached and cached[0] == etag and cached[1] > time.monotonic():
+        return ORJSONResponse(cached[2], headers=headers)
+
+    payload = compute_charts_financial_data(db)
+    # Calcular extractos faltantes toca raw_data, no el documento: el ETag sigue siendo válido
+    _charts_financial_cache = (etag, time.monotonic() + CHARTS_FINANCIAL_TTL_SECONDS, payload)
+    return ORJSONResponse(payload, headers=headers)
+
+
+def compute_charts_financial_data(db: Session) -> dict:
+    """Arma los datos de /charts/financial a partir de los extractos guardados"""
 
     # Buscar documentos de Estado de Resultados confirmados
-    docs = db.query(models.Document).filter(
+    # Documentos y datos raw en una sola consulta (LEFT JOIN uno a uno)
+    docs = db.query(models.Document).options(
+        # raw_parquet solo se carga si hay que calcular el extracto
+        joinedload(models.Document.raw_data).defer(models.RawDocumentData.raw_parquet)
+    ).filter(
         models.Document.status == "confirmed",
         models.Document.filename.ilike("%ESTADO DE RESULTADOS%")
     ).order_by(desc(models.Document.created_at)).limit(5).all()
@@ -2591,67 +4479,32 @@ async def get_charts_financial_data(
     total_ingresos = 0
     total_egresos = 0
     categories = {}
+    extracts_computed = False
 
     for doc in docs:
-        raw = db.query(models.RawDocumentData).filter(
-            models.RawDocumentData.document_id == doc.id
-        ).first()
+        raw = doc.raw_data
 
         if not raw or not raw.raw_json:
             continue
 
-        data = raw.raw_json.get("data", [])
-        if not data:
-            continue
-
-        # Primera fila tiene nombres de tiendas
-        header_row = data[0] if data else {}
-
-        # Extraer nombres de tiendas (columnas impares que no son %)
-        store_names = []
-        for key, val in header_row.items():
-            if val and isinstance(val, str) and val != "%" and "Unnamed" not in key:
-                store_names.append(val)
-
-        # Buscar filas de INGRESOS, EGRESOS, UTILIDAD
-        for row in data:
-            first_col = list(row.values())[0] if row else None
-            if not first_col:
+        # Precalculado al confirmar; documentos viejos se calculan una vez aquí
+        extract = raw.raw_json.get("chart_extract")
+        if extract is None:
+            extract = store_chart_extract(raw)
+            extracts_computed = True
+            if extract is None:
                 continue
 
-            first_col_str = str(first_col).upper().strip()
+        for store_name, values in extract["stores"].items():
+            entry = stores_data.setdefault(store_name, {"ingresos": 0, "egresos": 0, "utilidad": 0})
+            entry.update(values)
+        total_ingresos += extract["total_ingresos"]
+        total_egresos += extract["total_egresos"]
+        for category, amount in extract["categories"].items():
+            categories[category] = categories.get(category, 0) + amount
 
-            # Extraer valores por tienda
-            col_idx = 0
-            for key, val in row.items():
-                if "Unnamed" in key or not val:
-                    continue
-                if isinstance(val, (int, float)) and col_idx < len(store_names):
-                    store_name = store_names[col_idx] if col_idx < len(store_names) else f"Tienda {col_idx}"
-
-                    if store_name not in stores_data:
-                        stores_data[store_name] = {"ingresos": 0, "egresos": 0, "utilidad": 0}
-
-                    if first_col_str == "INGRESOS" or "VENTA" in first_col_str:
-                        stores_data[store_name]["ingresos"] = val
-                        total_ingresos += val
-                    elif first_col_str == "TOTAL EGRESOS" or first_col_str == "EGRESOS":
-                        stores_data[store_name]["egresos"] = val
-                        total_egresos += val
-                    elif "UTILIDAD" in first_col_str and "NETA" in first_col_str:
-                        stores_data[store_name]["utilidad"] = val
-
-                    # Categorizar gastos
-                    if any(x in first_col_str for x in ["NOMINA", "SALARIO", "SUELDO"]):
-                        categories["Nómina"] = categories.get("Nómina", 0) + val
-                    elif any(x in first_col_str for x in ["RENTA", "ALQUILER"]):
-                        categories["Renta"] = categories.get("Renta", 0) + val
-                    elif any(x in first_col_str for x in ["LUZ", "ELECTRICIDAD", "CFE"]):
-                        categories["Servicios"] = categories.get("Servicios", 0) + val
-                    elif any(x in first_col_str for x in ["COSTO", "INGREDIENTE", "MATERIA"]):
-                        categories["Costo de Venta"] = categories.get("Costo de Venta", 0) + val
-
-                col_idx += 1
+    if extracts_computed:
+        db.commit()
 
     # Preparar datos para gráficas
     stores_list = list(stores_data.keys())[:10]  # Top 10 tiendas
@@ -2683,7 +4536,7 @@ async def get_charts_financial_data(
 # ============================================
 
 @app.get("/api/charts/dashboard")
-async def get_dashboard_charts_data(
+def get_dashboard_charts_data(
     db: Session = Depends(get_db),
     period: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
@@ -2692,12 +4545,11 @@ async def get_dashboard_charts_data(
     Endpoint consolidado que retorna TODOS los datos necesarios
     para las 10 gráficas del dashboard con datos REALES.
     PROTEGIDO: Requiere autenticación
+    Sin await: FastAPI la corre en su threadpool
     """
     try:
-        # 1. Verificar si hay datos en monthly_summaries
-        summary_count = db.query(models.MonthlySummary).count()
-
-        if summary_count == 0:
+        # 1. Verificar si hay datos en monthly_summaries (basta con una fila)
+        if db.scalar(select(models.MonthlySummary.id).limit(1)) is None:
             return {
                 "success": True,
                 "has_data": False,
@@ -2705,10 +4557,12 @@ async def get_dashboard_charts_data(
             }
 
         # 2. Obtener periodos disponibles
+        # group_by en lugar de distinct: Postgres no permite ordenar un
+        # SELECT DISTINCT por expresiones que no están en el SELECT
         periods_query = db.query(
             models.MonthlySummary.period
-        ).distinct().order_by(
-            desc(models.MonthlySummary.period)
+        ).group_by(models.MonthlySummary.period).order_by(
+            *period_order(models.MonthlySummary.period, descending=True)
         ).limit(12).all()
 
         available_periods = [p[0] for p in periods_query]
@@ -3176,48 +5030,68 @@ async def get_dashboard_charts_data(
 import pathlib
 STATIC_DIR = pathlib.Path(__file__).parent.parent
 
-# Servir index.html en la raíz
-@app.get("/", response_class=FileResponse)
-async def serve_index():
-    return FileResponse(STATIC_DIR / "index.html")
 
-# Friendly URLs - rutas explícitas para cada página
-@app.get("/subir", response_class=FileResponse)
-async def serve_upload():
-    return FileResponse(STATIC_DIR / "upload.html")
+def load_html_pages() -> dict:
+    """Lee una vez las páginas .html de la raíz: {archivo: (mtime, bytes, etag)}"""
+    pages = {}
+    for file_path in STATIC_DIR.glob("*.html"):
+        content = file_path.read_bytes()
+        pages[file_path.name] = (file_path.stat().st_mtime, content, f'"{hashlib.md5(content).hexdigest()}"')
+    return pages
+
 
-@app.get("/julia", response_class=FileResponse)
-async def serve_julia():
-    return FileResponse(STATIC_DIR / "julia.html")
+# Lista blanca de páginas cargada al importar: cada request es un lookup en
+# memoria y un nombre desconocido da 404 sin tocar el disco.
+# Cambios a los .html requieren reiniciar el proceso (igual que un deploy)
+HTML_PAGES_CACHE = load_html_pages()
 
-@app.get("/vault", response_class=FileResponse)
-async def serve_documents():
-    return FileResponse(STATIC_DIR / "documents.html")
 
-@app.get("/graficas", response_class=FileResponse)
-async def serve_graficas():
-    return FileResponse(STATIC_DIR / "graficas.html")
+def serve_html_page(filename: str, request: Request) -> Response:
+    """Sirve una página HTML desde memoria con ETag/Last-Modified (304 si no cambió)"""
+    cached = HTML_PAGES_CACHE.get(filename)
+    if cached is None:
+        raise HTTPException(status_code=404, detail="Page not found")
 
-@app.get("/reportes", response_class=FileResponse)
-async def serve_reports():
-    return FileResponse(STATIC_DIR / "reports.html")
+    mtime, content, etag = cached
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(mtime, usegmt=True),
+        "Cache-Control": "public, max-age=60",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="text/html", headers=headers)
 
-@app.get("/config", response_class=FileResponse)
-async def serve_settings():
-    return FileResponse(STATIC_DIR / "settings.html")
 
-@app.get("/login", response_class=FileResponse)
-async def serve_login():
-    return FileResponse(STATIC_DIR / "login.html")
+# Friendly URLs -> página HTML. STATIC_DIR es la raíz del repo (incluye app/ y
+# la base de desarrollo), por eso no se monta con StaticFiles: solo se sirven
+# estas páginas y los .html de la raíz
+HTML_PAGES = {
+    "/": "index.html",
+    "/subir": "upload.html",
+    "/julia": "julia.html",
+    "/vault": "documents.html",
+    "/graficas": "graficas.html",
+    "/reportes": "reports.html",
+    "/config": "settings.html",
+    "/login": "login.html",
+}
 
-# También servir archivos .html directamente
-@app.get("/{filename}.html", response_class=FileResponse)
-async def serve_html(filename: str):
-    file_path = STATIC_DIR / f"{filename}.html"
-    if file_path.exists():
-        return FileResponse(file_path)
-    raise HTTPException(status_code=404, detail="Page not found")
 
+def add_html_page_route(path: str, filename: str):
+    async def serve_page(request: Request):
+        return serve_html_page(filename, request)
+    app.add_api_route(path, serve_page, methods=["GET"], response_class=HTMLResponse,
+                      name=f"page_{filename.removesuffix('.html')}")
+
+
+for page_path, page_file in HTML_PAGES.items():
+    add_html_page_route(page_path, page_file)
+
+# También servir archivos .html directamente
+@app.get("/{filename}.html", response_class=HTMLResponse)
+async def serve_html(filename: str, request: Request):
+    return serve_html_page(f"{filename}.html", request)
 
 # Punto de entrada
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+"""
+CICLOPS - Extracción de texto de PDFs
+
+Módulo sin efectos secundarios al importarse (no crea engine, clientes de AI
+ni tablas): es lo único que carga cada proceso del pool de PDFs grandes de
+main_postgres, que arranca con spawn.
+"""
+import re
+from io import BytesIO
+
+import pdfplumber
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+try:
+    import pypdfium2 as pdfium  # PDFium en C; dependencia de pdfplumber
+except ImportError:
+    pdfium = None
+
+
+def _format_table_row(row) -> str:
+    """Formatea una fila de tabla como 'celda | celda | ...'"""
+    return " | ".join([str(cell) if cell else "" for cell in row])
+
+
+# Montos/números tipo 1,234.56 | $-500 | 12.5%
+_PDF_NUMBER_RE = re.compile(r'-?\$?\d[\d,]*(?:\.\d+)?%?')
+# Fracción mínima de líneas con 2+ números para considerar que la página es una tabla
+PDF_TABULAR_LINE_RATIO = 0.3
+
+
+def _looks_tabular(text: str) -> bool:
+    """
+    Heurística barata sobre el texto de una página: si muchas líneas traen
+    varias cifras probablemente hay una tabla. Evita correr la detección
+    de tablas (cara) en páginas de texto corrido.
+    """
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return False
+    numeric_lines = sum(1 for line in lines if len(_PDF_NUMBER_RE.findall(line)) >= 2)
+    return numeric_lines / len(lines) >= PDF_TABULAR_LINE_RATIO
+
+
+def _extract_pdf_pages_pymupdf(content: bytes) -> str:
+    """Extrae texto página por página con PyMuPDF (motor en C)"""
+    text_content = []
+    doc = fitz.open(stream=content, filetype="pdf")
+    try:
+        for page in doc:
+            # Texto primero (barato); tablas solo si la página parece tabular
+            text = page.get_text("text").strip()
+            tables = page.find_tables().tables if _looks_tabular(text) else []
+            if tables:
+                for table in tables:
+                    for row in table.extract():
+                        if row:
+                            text_content.append(_format_table_row(row))
+            elif text:
+                text_content.append(text)
+    finally:
+        doc.close()
+    return "\n".join(text_content)
+
+
+def _extract_pdf_pages_pdfium(content: bytes) -> str:
+    """
+    Sin PyMuPDF: texto con PDFium (nativo, varias veces más rápido que
+    pdfminer) y pdfplumber solo para las páginas que parecen tabla.
+    """
+    text_content = []
+    pdf = pdfium.PdfDocument(content)
+    plumber_pdf = None
+    try:
+        for index in range(len(pdf)):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            text = textpage.get_text_range().replace("\r\n", "\n").strip()
+            textpage.close()
+            page.close()
+
+            tables = []
+            if text and _looks_tabular(text):
+                if plumber_pdf is None:
+                    plumber_pdf = pdfplumber.open(BytesIO(content))
+                plumber_page = plumber_pdf.pages[index]
+                tables = plumber_page.extract_tables()
+                plumber_page.flush_cache()
+            if tables:
+                for table in tables:
+                    for row in table:
+                        if row:
+                            text_content.append(_format_table_row(row))
+            elif text:
+                text_content.append(text)
+    finally:
+        pdf.close()
+        if plumber_pdf is not None:
+            plumber_pdf.close()
+    return "\n".join(text_content)
+
+
+def _extract_pdf_pages_pdfplumber(content: bytes) -> str:
+    """Fallback con pdfplumber, liberando el cache de cada página"""
+    text_content = []
+    with pdfplumber.open(BytesIO(content)) as pdf:
+        for page in pdf.pages:
+            # Texto primero (barato); tablas solo si la página parece tabular
+            text = page.extract_text()
+            tables = page.extract_tables() if text and _looks_tabular(text) else []
+            if tables:
+                for table in tables:
+                    for row in table:
+                        if row:
+                            text_content.append(_format_table_row(row))
+            elif text:
+                text_content.append(text)
+            # Sin esto pdfplumber retiene los objetos de layout de cada página
+            page.flush_cache()
+    return "\n".join(text_content)
+
+
+def extract_pdf_pages(content: bytes) -> str:
+    """Extrae texto de todas las páginas con el mejor motor disponible"""
+    if fitz is not None:
+        return _extract_pdf_pages_pymupdf(content)
+    if pdfium is not None:
+        return _extract_pdf_pages_pdfium(content)
+    return _extract_pdf_pages_pdfplumber(content)
+
+
+def pdf_page_count(content: bytes) -> int:
+    """Número de páginas del PDF"""
+    if fitz is not None:
+        with fitz.open(stream=content, filetype="pdf") as doc:
+            return doc.page_count
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(content)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    with pdfplumber.open(BytesIO(content)) as pdf:
+        return len(pdf.pages)
@@ -9,10 +9,22 @@ from .claude_service import (
     ClaudeService,
     get_claude_service,
 )
+from .firebase_service import (
+    FirebaseService,
+    get_firebase_service,
+    init_firebase,
+    get_firestore_client,
+    get_storage_bucket,
+)
 
 __all__ = [
     "PDFService",
     "get_pdf_service",
     "ClaudeService",
     "get_claude_service",
+    "FirebaseService",
+    "get_firebase_service",
+    "init_firebase",
+    "get_firestore_client",
+    "get_storage_bucket",
 ]
@@ -5,8 +5,12 @@ Aurelia: "Toda la interacción con Firebase pasa por aquí"
 import firebase_admin
 from firebase_admin import credentials, firestore, auth, storage
 from typing import Optional, Dict, Any, List
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
 import logging
+import os
+import tempfile
 
 from app.config import get_settings
 
@@ -33,10 +37,61 @@ def init_firebase():
     return _firebase_app
 
 
+# Opciones del canal gRPC: keep-alive para que el canal no se cierre
+# en periodos sin tráfico y el siguiente request no pague el handshake
+FIRESTORE_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+# Cliente compartido por todo el proceso
+FIRESTORE_CLIENT = None
+
+# Descargas de Storage: arriba de este tamaño se bajan en rangos paralelos
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_MAX_WORKERS = 4
+
+# Ventana en la que un create_document con el mismo contenido se considera
+# reintento y no se vuelve a escribir
+DEDUP_WINDOW_SECONDS = 60
+
+
+def _attach_keepalive_channel(client):
+    """
+    Reemplaza el canal gRPC del cliente antes de su primer uso.
+    El SDK solo configura keepalive_time_ms; aquí se agregan el resto
+    de las opciones de FIRESTORE_CHANNEL_OPTIONS.
+    """
+    from google.cloud.firestore_v1.services.firestore import client as firestore_api
+    from google.cloud.firestore_v1.services.firestore.transports.grpc import FirestoreGrpcTransport
+
+    channel = FirestoreGrpcTransport.create_channel(
+        client._target,
+        credentials=client._credentials,
+        options=FIRESTORE_CHANNEL_OPTIONS
+    )
+    transport = FirestoreGrpcTransport(host=client._target, channel=channel)
+    client._firestore_api_internal = firestore_api.FirestoreClient(
+        transport=transport,
+        client_options=client._client_options
+    )
+
+
 def get_firestore_client():
-    """Obtiene cliente de Firestore"""
-    init_firebase()
-    return firestore.client()
+    """Obtiene cliente de Firestore (compartido, con canal keep-alive)"""
+    global FIRESTORE_CLIENT
+    if FIRESTORE_CLIENT is None:
+        init_firebase()
+        client = firestore.client()
+        # El emulador usa su propio canal sin TLS; no tocarlo
+        if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+            try:
+                _attach_keepalive_channel(client)
+            except Exception as e:
+                logger.warning(f"Could not configure Firestore keep-alive channel: {e}")
+        FIRESTORE_CLIENT = client
+    return FIRESTORE_CLIENT
 
 
 def get_storage_bucket():
@@ -94,21 +149,58 @@ class FirebaseService:
         data: Dict[str, Any],
         doc_id: Optional[str] = None
     ) -> str:
-        """Crea un documento en Firestore"""
+        """
+        Crea un documento en Firestore.
+        Sin doc_id, si el mismo contenido se escribió hace menos de
+        DEDUP_WINDOW_SECONDS (p. ej. un reintento del cliente) regresa
+        el id existente en lugar de duplicarlo.
+        """
         try:
-            data["created_at"] = datetime.utcnow()
-            data["updated_at"] = datetime.utcnow()
-
             if doc_id:
+                # set() con id explícito ya es idempotente
+                data["created_at"] = data["updated_at"] = firestore.SERVER_TIMESTAMP
                 self.db.collection(collection).document(doc_id).set(data)
                 return doc_id
-            else:
-                doc_ref = self.db.collection(collection).add(data)
-                return doc_ref[1].id
+
+            content_hash = hashlib.blake2b(
+                json.dumps(data, sort_keys=True, default=str).encode(),
+                digest_size=16
+            ).hexdigest()
+            existing = self._find_recent_duplicate(collection, content_hash)
+            if existing is not None:
+                logger.info(f"Skipping duplicate write in {collection}: {existing.id}")
+                return existing.id
+
+            data["_content_hash"] = content_hash
+            # Timestamp del servidor: el cliente no calcula ni envía la hora
+            data["created_at"] = data["updated_at"] = firestore.SERVER_TIMESTAMP
+            doc_ref = self.db.collection(collection).add(data)
+            return doc_ref[1].id
         except Exception as e:
             logger.error(f"Failed to create document in {collection}: {e}")
             raise
 
+    def _find_recent_duplicate(self, collection: str, content_hash: str):
+        """
+        Documento con el mismo _content_hash escrito en la ventana de dedup.
+        Requiere el índice compuesto (_content_hash, created_at) de
+        firestore.indexes.json; si la consulta falla (índice sin desplegar,
+        FailedPrecondition) se trata como "no hay duplicado" y se escribe.
+        """
+        since = datetime.now(timezone.utc) - timedelta(seconds=DEDUP_WINDOW_SECONDS)
+        try:
+            duplicates = (
+                self.db.collection(collection)
+                .where("_content_hash", "==", content_hash)
+                .where("created_at", ">=", since)
+                .limit(1)
+                .stream()
+            )
+            return next(iter(duplicates), None)
+        except Exception as e:
+            logger.warning(f"Dedup check failed in {collection}, writing anyway: {e}")
+            return None
+
     async def get_document(
         self,
         collection: str,
@@ -134,7 +226,7 @@ class FirebaseService:
     ):
         """Actualiza un documento en Firestore"""
         try:
-            data["updated_at"] = datetime.utcnow()
+            data["updated_at"] = firestore.SERVER_TIMESTAMP
             self.db.collection(collection).document(doc_id).update(data)
         except Exception as e:
             logger.error(f"Failed to update document {doc_id}: {e}")
@@ -207,10 +299,28 @@ class FirebaseService:
             raise
 
     async def download_file(self, file_path: str) -> bytes:
-        """Descarga un archivo de Cloud Storage"""
+        """
+        Descarga un archivo de Cloud Storage.
+        Archivos grandes se bajan en rangos paralelos (sliced download).
+        """
         try:
-            blob = self.bucket.blob(file_path)
-            return blob.download_as_bytes()
+            blob = self.bucket.get_blob(file_path)
+            if blob is None or (blob.size or 0) <= DOWNLOAD_CHUNK_SIZE:
+                # Archivo chico (o inexistente: download_as_bytes lanza NotFound)
+                return (blob or self.bucket.blob(file_path)).download_as_bytes()
+
+            from google.cloud.storage import transfer_manager
+            # transfer_manager escribe cada rango en su offset de un archivo
+            with tempfile.NamedTemporaryFile() as tmp:
+                transfer_manager.download_chunks_concurrently(
+                    blob,
+                    tmp.name,
+                    chunk_size=DOWNLOAD_CHUNK_SIZE,
+                    worker_type=transfer_manager.THREAD,
+                    max_workers=DOWNLOAD_MAX_WORKERS
+                )
+                tmp.seek(0)
+                return tmp.read()
         except Exception as e:
             logger.error(f"Failed to download file: {e}")
             raise
@@ -226,7 +336,6 @@ class FirebaseService:
 
     async def get_signed_url(self, file_path: str, expiration: int = 3600) -> str:
         """Genera URL firmada para acceso temporal"""
-        from datetime import timedelta
         try:
             blob = self.bucket.blob(file_path)
             url = blob.generate_signed_url(
@@ -0,0 +1,71 @@
+"""
+CICLOPS - Deltas vs periodo anterior en monthly_summaries
+"""
+import os
+import tempfile
+
+import pytest
+
+# database.py lee DATABASE_URL al importarse: SQLite temporal antes de importar la app
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
+
+from app import db_models as models  # noqa: E402
+from app.main_postgres import SessionLocal, period_sort_key, upsert_monthly_summaries  # noqa: E402
+
+
+def summary_row(period: str, sales: float, profit: float, store: str = "Centro") -> dict:
+    return {
+        "store_id": store.lower(),
+        "store_name": store,
+        "period": period,
+        "total_sales": sales,
+        "net_profit": profit,
+    }
+
+
+def test_deltas_follow_numeric_period_order():
+    db = SessionLocal()
+    try:
+        # Como texto: P1 < P10 < P13 < P2 < P9
+        upsert_monthly_summaries([
+            summary_row("2025-P10", 1200, 300),
+            summary_row("2025-P1", 500, 100),
+            summary_row("2025-P13", 600, 150),
+            summary_row("2025-P9", 1000, 200),
+            summary_row("2025-P2", 750, 50),
+            summary_row("2026-P1", 900, 300),
+        ], db)
+        by_period = {s.period: s for s in db.query(models.MonthlySummary)}
+
+        assert by_period["2025-P1"].sales_vs_previous is None
+        assert float(by_period["2025-P2"].sales_vs_previous) == pytest.approx(50)    # vs P1
+        assert float(by_period["2025-P10"].sales_vs_previous) == pytest.approx(20)   # vs P9
+        assert float(by_period["2025-P10"].profit_vs_previous) == pytest.approx(50)
+        assert float(by_period["2025-P13"].sales_vs_previous) == pytest.approx(-50)  # vs P10
+        assert float(by_period["2026-P1"].sales_vs_previous) == pytest.approx(50)    # vs 2025-P13
+    finally:
+        db.close()
+
+
+def test_delta_is_null_for_near_zero_previous_value():
+    db = SessionLocal()
+    try:
+        # 0.50 -> 5,000 sería 999,900 %: no se calcula
+        upsert_monthly_summaries([
+            summary_row("2025-P3", 1000, 0.5, store="Norte"),
+            summary_row("2025-P4", 1100, 5000, store="Norte"),
+        ], db)
+        p4 = db.query(models.MonthlySummary).filter_by(store_id="norte", period="2025-P4").one()
+
+        assert p4.profit_vs_previous is None
+        assert float(p4.sales_vs_previous) == pytest.approx(10)
+    finally:
+        db.close()
+
+
+def test_period_sort_key_matches_numeric_order():
+    periods = ["2025-P9", "2025-P13", "2024-P12", "2025-P10", "2025-P1", "2025-P09"]
+    assert sorted(periods, key=period_sort_key, reverse=True)[:4] == [
+        "2025-P13", "2025-P10", "2025-P9", "2025-P09"
+    ]
+    assert sorted(periods, key=period_sort_key)[:2] == ["2024-P12", "2025-P1"]
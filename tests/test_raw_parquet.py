@@ -0,0 +1,42 @@
+"""
+CICLOPS - Datos raw de Excel/CSV guardados como Parquet
+"""
+import os
+import tempfile
+from types import SimpleNamespace
+
+import openpyxl
+
+# database.py lee DATABASE_URL al importarse: SQLite temporal antes de importar la app
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+
+from app.main_postgres import (  # noqa: E402
+    dataframe_to_parquet, dataframe_to_records, load_raw_records, parse_tabular_upload
+)
+
+
+def write_estado_de_resultados(path: str):
+    """Layout del P&L de LC: nombres de tienda en la primera fila de las columnas numéricas"""
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "P10"
+    ws.append(["ESTADO DE RESULTADOS", None, None, None])
+    ws.append(["CONCEPTO", "CENTRO", "NORTE", "TOTAL"])
+    ws.append(["INGRESOS", 125000, 98000.5, 223000.5])
+    ws.append(["NOMINA", 30000, 25000, 55000])
+    ws.append(["RENTA", 12000, None, 12000])
+    ws.append(["UTILIDAD", 83000, 73000.5, 156000.5])
+    wb.save(path)
+
+
+def test_pnl_layout_round_trips_through_parquet(tmp_path):
+    path = str(tmp_path / "ESTADO DE RESULTADOS P10.xlsx")
+    write_estado_de_resultados(path)
+    with open(path, "rb") as source:
+        combined_df = parse_tabular_upload(source, os.path.basename(path).lower())[0]
+
+    raw_parquet = dataframe_to_parquet(combined_df)
+
+    assert raw_parquet is not None
+    raw = SimpleNamespace(raw_parquet=raw_parquet, raw_json={})
+    assert load_raw_records(raw) == dataframe_to_records(combined_df)
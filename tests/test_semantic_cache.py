@@ -0,0 +1,43 @@
+"""
+CICLOPS - Cache semántico de respuestas de /chat
+"""
+import os
+import tempfile
+
+import numpy as np
+
+# database.py lee DATABASE_URL al importarse: SQLite temporal antes de importar la app
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+
+from app.main_postgres import SemanticResponseCache, question_entities  # noqa: E402
+
+STORES = frozenset({"centro", "norte"})
+# Mismo embedding para todas: solo las entidades distinguen las preguntas
+EMBEDDING = np.ones(4) / 2
+
+
+def cache_with(question: str) -> SemanticResponseCache:
+    cache = SemanticResponseCache(threshold=0.9)
+    cache.put("scope", question, EMBEDDING, {"response": question}, question_entities(question, STORES))
+    return cache
+
+
+def test_questions_about_other_store_do_not_share_answer():
+    cache = cache_with("ventas de centro en P9")
+    entities = question_entities("ventas de norte en P9", STORES)
+
+    assert cache.find_similar("scope", EMBEDDING, entities) is None
+
+
+def test_questions_about_other_period_do_not_share_answer():
+    cache = cache_with("ventas de Centro en P9")
+    entities = question_entities("ventas de Centro en P10", STORES)
+
+    assert cache.find_similar("scope", EMBEDDING, entities) is None
+
+
+def test_equivalent_question_with_same_entities_hits():
+    cache = cache_with("ventas de Centro en P9")
+    entities = question_entities("¿cuánto vendió centro en el P09?", STORES)
+
+    assert cache.find_similar("scope", EMBEDDING, entities) == {"response": "ventas de Centro en P9"}